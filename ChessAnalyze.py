@@ -0,0 +1,260 @@
+# Description: headless batch analysis. Positions and games are streamed lazily from PGN, FEN/EPD or binary position
+# files, analysed in worker processes and written out as JSON lines, one line per input record, in input order.
+# A bounded number of batches is in flight at any time so a fast reader can't run ahead of the workers, and a run
+# that was stopped can carry on where its output file ends.
+#
+# usage: python ChessAnalyze.py games.pgn -o games.jsonl --workers 8 --depth 3
+#        python ChessAnalyze.py positions.epd -o out.jsonl --time 0.5 --resume
+#        python ChessAnalyze.py positions.bin -o out.jsonl           (32-byte records from GameState.toBytes)
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import ChessEngine
+import ChessSearch
+
+PGN_TAG = re.compile(r'\[(\w+)\s+"((?:[^"\\]|\\.)*)"\]')
+PGN_NOISE = re.compile(r'\{[^}]*\}|;[^\n]*|\$\d+') #comments and numeric annotation glyphs
+PGN_MOVE_NUMBER = re.compile(r'^\d+\.+')
+PGN_RESULTS = ("1-0", "0-1", "1/2-1/2", "*")
+
+
+#one FEN or EPD position per line. EPD lines have no move counters and may carry operations after the fourth field
+def readFenFile(path):
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split()
+            if len(fields) >= 6 and fields[4].isdigit() and fields[5].isdigit():
+                yield ("fen", " ".join(fields[:6]))
+            else:
+                yield ("fen", " ".join(fields[:4]))
+
+
+#one game at a time: (headers, list of SAN moves). variations are skipped, only the main line is kept
+def readPgnFile(path):
+    headers = {}
+    moveText = []
+    with open(path, errors="replace") as f:
+        for line in f:
+            stripped = line.strip()
+            if stripped.startswith('['):
+                if moveText: #a tag after movetext starts the next game
+                    yield ("pgn", (headers, parseMoveText("\n".join(moveText))))
+                    headers, moveText = {}, []
+                tag = PGN_TAG.match(stripped)
+                if tag:
+                    headers[tag.group(1)] = tag.group(2)
+            elif stripped:
+                moveText.append(stripped) #joined with newlines below so a ; comment ends with its line
+    if moveText or headers:
+        yield ("pgn", (headers, parseMoveText("\n".join(moveText))))
+
+
+def parseMoveText(text):
+    text = PGN_NOISE.sub(" ", text)
+    moves = []
+    depth = 0 #nesting of ( ) variations
+    for token in text.replace("(", " ( ").replace(")", " ) ").split():
+        if token == "(":
+            depth += 1
+        elif token == ")":
+            depth -= 1
+        elif depth == 0 and token not in PGN_RESULTS:
+            token = PGN_MOVE_NUMBER.sub("", token)
+            if token:
+                moves.append(token)
+    return moves
+
+
+#raw position records, the file is memory-mapped and never read in one go
+def readPositionRecords(path):
+    for record in ChessEngine.readPositionRecords(path):
+        yield ("bin", record)
+
+
+def readRecords(path, format="auto"):
+    if format == "auto":
+        extension = os.path.splitext(path)[1].lower()
+        format = {".pgn": "pgn", ".bin": "bin"}.get(extension, "fen")
+    if format == "pgn":
+        return readPgnFile(path)
+    if format == "bin":
+        return readPositionRecords(path)
+    return readFenFile(path)
+
+
+def analyzePosition(gs, options):
+    moves = gs.getValidMoves()
+    result = {
+        "fen": gs.toFen(),
+        "legalMoves": len(moves),
+        "inCheck": gs.inCheck,
+        "eval": ChessSearch.evaluate(gs), #centipawns, side to move
+    }
+    if not moves:
+        result["result"] = "checkmate" if gs.inCheck else "stalemate"
+    elif options.get("depth") or options.get("time"):
+        searcher = ChessSearch.Searcher(ttSizeMB=options.get("hash", 16))
+        found = searcher.search(gs, options.get("depth") or 64, options.get("time"))
+        result.update({
+            "bestMove": found.bestMove.getChessNotation(),
+            "score": found.score,
+            "depth": found.depth,
+            "pv": [m.getChessNotation() for m in found.pv],
+            "nodes": found.nodes,
+        })
+    return result
+
+
+def analyzeRecord(kind, payload, options):
+    backend = options.get("backend", "mailbox")
+    if kind == "fen":
+        return analyzePosition(ChessEngine.GameState.fromFen(payload, backend), options)
+    if kind == "bin":
+        return analyzePosition(ChessEngine.GameState.fromBytes(payload, 0, backend), options)
+    headers, sanMoves = payload
+    gs = ChessEngine.GameState.fromFen(headers["FEN"], backend) if "FEN" in headers else ChessEngine.GameState(backend)
+    result = {"headers": headers, "plies": len(sanMoves)}
+    positions = []
+    for ply, san in enumerate(sanMoves):
+        if options.get("everyPly"):
+            positions.append(analyzePosition(gs, options))
+        try:
+            gs.makeMove(gs.moveFromSan(san))
+        except ValueError as e:
+            result["error"] = "ply %d: %s" % (ply + 1, e)
+            result["plies"] = ply
+            break
+    positions.append(analyzePosition(gs, options))
+    if options.get("everyPly"):
+        result["positions"] = positions
+    else:
+        result["final"] = positions[-1]
+    return result
+
+
+#runs in a worker: analyse a batch of (index, kind, payload) records and return their output lines
+def analyzeBatch(batch, options):
+    lines = []
+    for index, kind, payload in batch:
+        try:
+            result = analyzeRecord(kind, payload, options)
+        except Exception as e: #one bad record must not stop a nightly run
+            result = {"error": "%s: %s" % (type(e).__name__, e)}
+        result["record"] = index
+        lines.append(json.dumps(result))
+    return lines
+
+
+def batches(records, size, skip):
+    batch = []
+    for index, (kind, payload) in enumerate(records):
+        if index < skip:
+            continue
+        batch.append((index, kind, payload))
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+#number of records already in an output file. a line cut off by a crash is truncated so the file stays valid
+def resumePoint(outputPath):
+    if not os.path.exists(outputPath):
+        return 0
+    lastRecord = -1
+    goodLength = 0
+    with open(outputPath, "rb+") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                lastRecord = json.loads(line)["record"]
+            except (ValueError, KeyError):
+                break
+            goodLength += len(line)
+        f.truncate(goodLength)
+    return lastRecord + 1
+
+
+#stream records through analyzeBatch and write the lines in input order. at most maxInFlight batches are queued at
+#once, the reader is only advanced when a slot frees up. workers=0 runs everything in this process
+def runPipeline(records, output, options, workers=None, batchSize=16, maxInFlight=None, skip=0, progress=None,
+                progressInterval=5.0):
+    start = time.perf_counter()
+    lastReport = start
+    done = 0
+    pool = ProcessPoolExecutor(workers) if workers != 0 else None
+    maxInFlight = maxInFlight or 2 * (workers or os.cpu_count() or 1)
+    pending = deque()
+
+    def writeBatch(lines):
+        output.write("".join(line + "\n" for line in lines))
+        output.flush()
+        return len(lines)
+
+    try:
+        for batch in batches(records, batchSize, skip):
+            if pool is None:
+                done += writeBatch(analyzeBatch(batch, options))
+            else:
+                pending.append(pool.submit(analyzeBatch, batch, options))
+                while len(pending) >= maxInFlight or (pending and pending[0].done()):
+                    done += writeBatch(pending.popleft().result())
+            if progress is not None and time.perf_counter() - lastReport >= progressInterval:
+                lastReport = time.perf_counter()
+                reportProgress(progress, done, skip, lastReport - start)
+        while pending:
+            done += writeBatch(pending.popleft().result())
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    seconds = time.perf_counter() - start
+    if progress is not None:
+        reportProgress(progress, done, skip, seconds)
+    return done, seconds
+
+
+def reportProgress(stream, done, skipped, seconds):
+    rate = done / seconds if seconds > 0 else 0
+    stream.write("%d records (%d skipped) in %.1fs, %.1f records/s\n" % (done, skipped, seconds, rate))
+    stream.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="stream positions or games through ChessEngine analysis")
+    parser.add_argument("input", help="PGN, FEN/EPD (one per line) or binary position file")
+    parser.add_argument("-o", "--output", required=True, help="JSONL output file")
+    parser.add_argument("--format", default="auto", choices=["auto", "pgn", "fen", "bin"])
+    parser.add_argument("--backend", default="mailbox", choices=["mailbox", "bitboard"])
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes, 0 runs in-process")
+    parser.add_argument("--batch", type=int, default=16, help="records per worker task")
+    parser.add_argument("--depth", type=int, help="search every position to this depth")
+    parser.add_argument("--time", type=float, help="search every position for this many seconds")
+    parser.add_argument("--hash", type=int, default=16, help="transposition table size in MB per search")
+    parser.add_argument("--every-ply", action="store_true", help="analyse every position of a game, not only the last")
+    parser.add_argument("--resume", action="store_true", help="skip the records already in the output file")
+    parser.add_argument("--quiet", action="store_true", help="no progress on stderr")
+    args = parser.parse_args(argv)
+
+    options = {"backend": args.backend, "depth": args.depth, "time": args.time, "hash": args.hash,
+               "everyPly": args.every_ply}
+    skip = resumePoint(args.output) if args.resume else 0
+    with open(args.output, "a" if args.resume else "w") as output:
+        runPipeline(readRecords(args.input, args.format), output, options, args.workers, args.batch, skip=skip,
+                    progress=None if args.quiet else sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,160 @@
+# Description: vectorized evaluation of many positions at once with NumPy. Positions are an (N, 64) int8 array of
+# piece codes (Move.pieceCodes, 0 for an empty square, square = row*8 + col) and every term is computed for the whole
+# batch with array operations: material and piece-square tables, mobility and pawn structure.
+# Needs numpy, which the rest of the engine does not.
+
+import numpy as np
+
+import ChessEngine
+
+PIECE_INDEX = {piece: i for i, piece in enumerate(ChessEngine.PIECES)} #plane index, the piece code minus one
+MOBILITY_WEIGHTS = {'N': 4, 'B': 4, 'R': 2, 'Q': 1}
+DOUBLED_PAWN = -15
+ISOLATED_PAWN = -12
+PASSED_PAWN = np.array([0, 10, 15, 25, 40, 60, 90, 0]) #by number of ranks advanced from the starting rank
+
+#material plus piece-square value of every piece on every square from white's point of view, the same tables
+#GameState.evaluate keeps incrementally, and the phase weight of every piece
+MG_VALUES = np.array([ChessEngine.MG_SCORES[piece] for piece in ChessEngine.PIECES], dtype=np.int32)
+EG_VALUES = np.array([ChessEngine.EG_SCORES[piece] for piece in ChessEngine.PIECES], dtype=np.int32)
+PHASES = np.array([ChessEngine.PIECE_PHASES[piece] for piece in ChessEngine.PIECES], dtype=np.int32)
+SQUARE_BITS = np.uint64(1) << np.arange(64, dtype=np.uint64)
+#squares a one step shift in column direction dc may land on without wrapping around to the other side of the board
+COLUMN_MASKS = {dc: np.uint64(sum(1 << sq for sq in range(64) if 0 <= sq % 8 - dc < 8)) for dc in range(-2, 3)}
+
+
+#bitboard of the squares one step (dr, dc) away, square = row*8 + col so a step is a shift by dr*8 + dc
+def shift(bitboards, d):
+    step = d[0] * 8 + d[1]
+    if step > 0:
+        moved = bitboards << np.uint64(step)
+    else:
+        moved = bitboards >> np.uint64(-step)
+    return moved & COLUMN_MASKS[d[1]]
+
+
+if hasattr(np, "bitwise_count"):
+    popcount = np.bitwise_count
+else: #numpy before 2.0
+    BYTE_COUNTS = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def popcount(bitboards):
+        return BYTE_COUNTS[bitboards.view(np.uint8)].reshape(bitboards.shape + (8,)).sum(axis=-1)
+
+
+#(N, 64) int8 piece codes for a list of GameStates, plus an (N,) bool array that is True when white is to move
+def statesToArray(states):
+    codes = ChessEngine.Move.pieceCodes
+    boards = np.array([[codes[piece] for row in gs.board for piece in row] for gs in states], dtype=np.int8)
+    whiteToMove = np.array([gs.whiteToMove for gs in states], dtype=bool)
+    return boards.reshape(len(states), 64), whiteToMove
+
+
+#(N, 12, 64) bool piece planes in ChessEngine.PIECES order
+def piecePlanes(boards):
+    return boards[:, None, :] == np.arange(1, 13, dtype=np.int8)[None, :, None]
+
+
+#middlegame and endgame sums blended by the game phase, like GameState.evaluate
+def materialAndPst(planes):
+    planes = planes.astype(np.int32)
+    mg = np.einsum('npk,pk->n', planes, MG_VALUES)
+    eg = np.einsum('npk,pk->n', planes, EG_VALUES)
+    phase = np.minimum(planes.sum(axis=2) @ PHASES, ChessEngine.MAX_PHASE)
+    return (mg * phase + eg * (ChessEngine.MAX_PHASE - phase)) // ChessEngine.MAX_PHASE
+
+
+#(N, 12) uint64 bitboards, one per piece plane
+def planesToBitboards(planes):
+    return np.bitwise_or.reduce(np.where(planes, SQUARE_BITS, np.uint64(0)), axis=2)
+
+
+#attacked squares of all the sliders in a bitboard: the rays are grown one step at a time through empty squares
+def slidingAttacks(pieces, empty, directions):
+    attacks = np.zeros_like(pieces)
+    for d in directions:
+        ray = pieces
+        for _ in range(7):
+            ray = shift(ray, d)
+            attacks |= ray
+            ray &= empty
+            if not ray.any():
+                break
+    return attacks
+
+
+#pseudo mobility: squares each side's minor and major pieces attack that are not occupied by their own pieces.
+#attacks of pieces of one kind are merged, two rooks covering the same square count it once
+def mobility(planes):
+    bitboards = planesToBitboards(planes)
+    empty = ~np.bitwise_or.reduce(bitboards, axis=1)
+    score = np.zeros(planes.shape[0], dtype=np.int32)
+    for color, sign in (('w', 1), ('b', -1)):
+        own = np.bitwise_or.reduce(bitboards[:, [PIECE_INDEX[color + t] for t in "pRNBQK"]], axis=1)
+        for kind, weight in MOBILITY_WEIGHTS.items():
+            pieces = bitboards[:, PIECE_INDEX[color + kind]]
+            if not pieces.any():
+                continue
+            if kind == 'N':
+                attacks = np.zeros_like(pieces)
+                for d in ChessEngine.KNIGHT_OFFSETS:
+                    attacks |= shift(pieces, d)
+            else:
+                directions = {'R': ChessEngine.DIRECTIONS[:4], 'B': ChessEngine.DIRECTIONS[4:],
+                              'Q': ChessEngine.DIRECTIONS}[kind]
+                attacks = slidingAttacks(pieces, empty, directions)
+            score += sign * weight * popcount(attacks & ~own).astype(np.int32)
+    return score
+
+
+#doubled, isolated and passed pawns for both sides
+def pawnStructure(planes):
+    white = planes[:, PIECE_INDEX['wp'], :].reshape(-1, 8, 8) #(N, row, col)
+    black = planes[:, PIECE_INDEX['bp'], :].reshape(-1, 8, 8)
+    score = np.zeros(planes.shape[0], dtype=np.int32)
+    rows = np.arange(8)[None, :, None]
+    for pawns, enemy, sign in ((white, black, 1), (black, white, -1)):
+        files = pawns.sum(axis=1) #(N, 8) pawns per file
+        score += sign * DOUBLED_PAWN * np.maximum(files - 1, 0).sum(axis=1)
+        hasPawn = files > 0
+        neighbours = np.zeros_like(hasPawn)
+        neighbours[:, 1:] |= hasPawn[:, :-1]
+        neighbours[:, :-1] |= hasPawn[:, 1:]
+        score += sign * ISOLATED_PAWN * (files * ~neighbours).sum(axis=1)
+
+        #a pawn is passed when no enemy pawn on its own or a neighbouring file is in front of it. front is the
+        #enemy pawn furthest up the board per file, padded with "no pawn" for the a and h file neighbours
+        if sign == 1:
+            front = np.where(enemy, rows, 8).min(axis=1)
+            front = np.pad(front, ((0, 0), (1, 1)), constant_values=8)
+            blockers = np.minimum(np.minimum(front[:, :-2], front[:, 1:-1]), front[:, 2:]) #(N, 8)
+            passed = pawns & (blockers[:, None, :] >= rows)
+            advanced = 6 - rows
+        else:
+            front = np.where(enemy, rows, -1).max(axis=1)
+            front = np.pad(front, ((0, 0), (1, 1)), constant_values=-1)
+            blockers = np.maximum(np.maximum(front[:, :-2], front[:, 1:-1]), front[:, 2:])
+            passed = pawns & (blockers[:, None, :] <= rows)
+            advanced = rows - 1
+        bonus = PASSED_PAWN[np.clip(advanced, 0, 7)].reshape(1, 8, 1)
+        score += sign * (passed * bonus).sum(axis=(1, 2)).astype(np.int32)
+    return score
+
+
+#centipawn scores for a batch of (N, 64) boards or (N, 12, 64) piece planes. from white's point of view, or from the
+#side to move's point of view when whiteToMove is given
+def evaluateBatch(positions, whiteToMove=None):
+    positions = np.asarray(positions)
+    if positions.ndim == 3:
+        planes = positions.astype(bool)
+    else:
+        planes = piecePlanes(positions.astype(np.int8).reshape(-1, 64))
+    scores = materialAndPst(planes) + mobility(planes) + pawnStructure(planes)
+    if whiteToMove is not None:
+        scores = np.where(np.asarray(whiteToMove, dtype=bool), scores, -scores)
+    return scores
+
+
+def evaluateStates(states):
+    boards, whiteToMove = statesToArray(states)
+    return evaluateBatch(boards, whiteToMove)
@@ -0,0 +1,404 @@
+# Description: This file contains the bitboard backend for GameState. The position is kept as one 64-bit integer per piece
+# (plus one per color) and legal moves are generated with precomputed attack tables instead of walking the 8x8 board.
+# Square numbering follows the board list: square = row * 8 + col, so bit 0 is a8 and bit 63 is h1.
+
+import ChessEngine
+
+FULL_BOARD = (1 << 64) - 1
+
+ROOK_DIRECTIONS = ((-1, 0), (1, 0), (0, -1), (0, 1))
+BISHOP_DIRECTIONS = ((-1, -1), (-1, 1), (1, -1), (1, 1))
+
+
+#walk from a square in one direction, stopping at the edge or at the first occupied square (which is included)
+def slidingAttacks(sq, directions, occupancy):
+    attacks = 0
+    r, c = divmod(sq, 8)
+    for d in directions:
+        endRow, endCol = r + d[0], c + d[1]
+        while 0 <= endRow < 8 and 0 <= endCol < 8:
+            bit = 1 << (endRow * 8 + endCol)
+            attacks |= bit
+            if occupancy & bit:
+                break
+            endRow += d[0]
+            endCol += d[1]
+    return attacks
+
+
+#squares whose occupancy matters for a slider on sq: the rays without their last (edge) square
+def relevantMask(sq, directions):
+    mask = 0
+    r, c = divmod(sq, 8)
+    for d in directions:
+        endRow, endCol = r + d[0], c + d[1]
+        while 0 <= endRow + d[0] < 8 and 0 <= endCol + d[1] < 8:
+            mask |= 1 << (endRow * 8 + endCol)
+            endRow += d[0]
+            endCol += d[1]
+    return mask
+
+
+#for every square, map each subset of the relevant mask to the attack set. this is the magic bitboard idea with
+#python's dict acting as the perfect hash, so a lookup is just ATTACKS[sq][occupancy & MASKS[sq]]
+def buildSlidingTables(directions):
+    masks = []
+    tables = []
+    for sq in range(64):
+        mask = relevantMask(sq, directions)
+        table = {}
+        subset = 0
+        while True:
+            table[subset] = slidingAttacks(sq, directions, subset)
+            subset = (subset - mask) & mask #carry-rippler trick to enumerate all subsets of the mask
+            if subset == 0:
+                break
+        masks.append(mask)
+        tables.append(table)
+    return masks, tables
+
+
+def buildStepTable(steps):
+    table = []
+    for sq in range(64):
+        r, c = divmod(sq, 8)
+        attacks = 0
+        for s in steps:
+            endRow, endCol = r + s[0], c + s[1]
+            if 0 <= endRow < 8 and 0 <= endCol < 8:
+                attacks |= 1 << (endRow * 8 + endCol)
+        table.append(attacks)
+    return table
+
+
+#squares strictly between two aligned squares, and the full line through them (0 if they are not aligned)
+def buildLineTables():
+    between = [[0] * 64 for _ in range(64)]
+    line = [[0] * 64 for _ in range(64)]
+    for sq in range(64):
+        r, c = divmod(sq, 8)
+        for d in ROOK_DIRECTIONS + BISHOP_DIRECTIONS:
+            ray = slidingAttacks(sq, (d,), 0) | slidingAttacks(sq, ((-d[0], -d[1]),), 0) | (1 << sq)
+            path = 0
+            endRow, endCol = r + d[0], c + d[1]
+            while 0 <= endRow < 8 and 0 <= endCol < 8:
+                target = endRow * 8 + endCol
+                between[sq][target] = path
+                line[sq][target] = ray
+                path |= 1 << target
+                endRow += d[0]
+                endCol += d[1]
+    return between, line
+
+
+KNIGHT_ATTACKS = buildStepTable(((-2, -1), (-1, -2), (1, -2), (2, -1), (2, 1), (1, 2), (-1, 2), (-2, 1)))
+KING_ATTACKS = buildStepTable(((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)))
+#squares attacked by a pawn of the given color standing on a square
+PAWN_ATTACKS = {'w': buildStepTable(((-1, -1), (-1, 1))), 'b': buildStepTable(((1, -1), (1, 1)))}
+ROOK_MASKS, ROOK_TABLES = buildSlidingTables(ROOK_DIRECTIONS)
+BISHOP_MASKS, BISHOP_TABLES = buildSlidingTables(BISHOP_DIRECTIONS)
+BETWEEN, LINE = buildLineTables()
+RANK_2 = 0xFF << 48
+RANK_7 = 0xFF << 8
+PROMOTION_RANKS = 0xFF | 0xFF << 56
+
+
+#a check or pin in the format of GameState.checkForPinsAndChecks: (row, col, direction from the king). the direction
+#is one step along the line, or the knight's jump for a knight
+def lineEntry(kingSq, sq, knight=False):
+    kingRow, kingCol = divmod(kingSq, 8)
+    r, c = divmod(sq, 8)
+    if knight:
+        return (r, c, r - kingRow, c - kingCol)
+    return (r, c, (r > kingRow) - (r < kingRow), (c > kingCol) - (c < kingCol))
+
+
+def rookAttacks(sq, occupancy):
+    return ROOK_TABLES[sq][occupancy & ROOK_MASKS[sq]]
+
+
+def bishopAttacks(sq, occupancy):
+    return BISHOP_TABLES[sq][occupancy & BISHOP_MASKS[sq]]
+
+
+class BitboardGameState(ChessEngine.GameState):
+    tracksAttacks = False
+
+    def syncBoard(self):
+        super().syncBoard()
+        self.bitboards = {piece: 0 for piece in ChessEngine.PIECES}
+        self.occupancy = {'w': 0, 'b': 0}
+        for r in range(8):
+            for c in range(8):
+                piece = self.board[r][c]
+                if piece != "--":
+                    self.bitboards[piece] |= 1 << (r * 8 + c)
+                    self.occupancy[piece[0]] |= 1 << (r * 8 + c)
+
+    #makeMove and undoMove write every square change through here, the bitboards are updated with xor so the same
+    #code undoes a move
+    def setSquares(self, changes, undo):
+        super().setSquares(changes, undo)
+        self.updateBitboards(changes)
+
+    def updateBitboards(self, changes):
+        bbs = self.bitboards
+        occupancy = self.occupancy
+        for sq, before, after in changes:
+            bit = 1 << sq
+            if before != "--":
+                bbs[before] ^= bit
+                occupancy[before[0]] ^= bit
+            if after != "--":
+                bbs[after] ^= bit
+                occupancy[after[0]] ^= bit
+
+    #bitboard of all pieces of the given color attacking sq with the given occupancy
+    def attackersOf(self, sq, color, occupancy):
+        bbs = self.bitboards
+        enemy = 'b' if color == 'w' else 'w'
+        return ((KNIGHT_ATTACKS[sq] & bbs[color + 'N']) |
+                (KING_ATTACKS[sq] & bbs[color + 'K']) |
+                (PAWN_ATTACKS[enemy][sq] & bbs[color + 'p']) |
+                (ROOK_TABLES[sq][occupancy & ROOK_MASKS[sq]] & (bbs[color + 'R'] | bbs[color + 'Q'])) |
+                (BISHOP_TABLES[sq][occupancy & BISHOP_MASKS[sq]] & (bbs[color + 'B'] | bbs[color + 'Q'])))
+
+    #(bitboard of the pieces checking the king on kingSq, checks, {pinned square: line it may move along}, pins),
+    #checks and pins in the format of checkForPinsAndChecks
+    def findPinsAndChecks(self, kingSq, ally, enemy):
+        bbs = self.bitboards
+        us = self.occupancy[ally]
+        them = self.occupancy[enemy]
+        occupancy = us | them
+        checkers = self.attackersOf(kingSq, enemy, occupancy)
+        checks = []
+        remaining = checkers
+        while remaining:
+            bit = remaining & -remaining
+            remaining ^= bit
+            checks.append(lineEntry(kingSq, bit.bit_length() - 1, bbs[enemy + 'N'] & bit != 0))
+
+        #pinned pieces: enemy sliders that see the king through exactly one of our pieces
+        pinLines = {}
+        pins = []
+        snipers = ((rookAttacks(kingSq, them) & (bbs[enemy + 'R'] | bbs[enemy + 'Q'])) |
+                   (bishopAttacks(kingSq, them) & (bbs[enemy + 'B'] | bbs[enemy + 'Q'])))
+        while snipers:
+            bit = snipers & -snipers
+            snipers ^= bit
+            sniperSq = bit.bit_length() - 1
+            blockers = BETWEEN[kingSq][sniperSq] & occupancy
+            if blockers and not blockers & (blockers - 1) and blockers & us:
+                pinnedSq = blockers.bit_length() - 1
+                pinLines[pinnedSq] = LINE[kingSq][sniperSq]
+                pins.append(lineEntry(kingSq, pinnedSq))
+        return checkers, checks, pinLines, pins
+
+    #all fully legal moves: checks and pins are resolved with masks, so no move is ever made and taken back here
+    def generateValidMoves(self):
+        return self.generateMoves(FULL_BOARD)
+
+    #the legal moves that end on a square of the allowed bitboard
+    def generateMoves(self, allowed):
+        moves = []
+        board = self.board
+        bbs = self.bitboards
+        if self.whiteToMove:
+            ally, enemy = 'w', 'b'
+        else:
+            ally, enemy = 'b', 'w'
+        us = self.occupancy[ally]
+        them = self.occupancy[enemy]
+        occupancy = us | them
+        kingBB = bbs[ally + 'K']
+        kingSq = kingBB.bit_length() - 1
+        kingStart = divmod(kingSq, 8)
+
+        checkers, self.checks, pinLines, self.pins = self.findPinsAndChecks(kingSq, ally, enemy)
+        self.inCheck = checkers != 0
+
+        #king moves, with the king lifted off the board so it can't hide behind itself from a slider
+        withoutKing = occupancy ^ kingBB
+        targets = KING_ATTACKS[kingSq] & ~us & allowed
+        while targets:
+            bit = targets & -targets
+            targets ^= bit
+            sq = bit.bit_length() - 1
+            if not self.attackersOf(sq, enemy, withoutKing):
+                moves.append(ChessEngine.Move(kingStart, divmod(sq, 8), board))
+
+        if checkers & (checkers - 1): #double check, only the king can move
+            return moves
+        if not checkers:
+            self.addCastleMoves(kingSq, occupancy, allowed, moves)
+        if checkers:
+            checkerSq = checkers.bit_length() - 1
+            targetMask = BETWEEN[kingSq][checkerSq] | checkers
+        else:
+            targetMask = FULL_BOARD
+
+        notUs = ~us & targetMask & allowed
+        for piece, attacksFrom in ((ally + 'N', None), (ally + 'B', bishopAttacks), (ally + 'R', rookAttacks),
+                                   (ally + 'Q', None)):
+            pieces = bbs[piece]
+            while pieces:
+                bit = pieces & -pieces
+                pieces ^= bit
+                sq = bit.bit_length() - 1
+                if piece[1] == 'N':
+                    if sq in pinLines: #a pinned knight can never move
+                        continue
+                    targets = KNIGHT_ATTACKS[sq] & notUs
+                elif piece[1] == 'Q':
+                    targets = (rookAttacks(sq, occupancy) | bishopAttacks(sq, occupancy)) & notUs
+                else:
+                    targets = attacksFrom(sq, occupancy) & notUs
+                if sq in pinLines:
+                    targets &= pinLines[sq]
+                self.addMoves(sq, targets, moves)
+
+        #pawns
+        pawns = bbs[ally + 'p']
+        while pawns:
+            bit = pawns & -pawns
+            pawns ^= bit
+            sq = bit.bit_length() - 1
+            if self.whiteToMove:
+                push = bit >> 8 & ~occupancy
+                if push and bit & RANK_2:
+                    push |= push >> 8 & ~occupancy
+            else:
+                push = bit << 8 & ~occupancy
+                if push and bit & RANK_7:
+                    push |= push << 8 & ~occupancy
+            targets = (push | (PAWN_ATTACKS[ally][sq] & them)) & targetMask & allowed
+            if sq in pinLines:
+                targets &= pinLines[sq]
+            if targets & PROMOTION_RANKS:
+                self.addPawnMoves(sq, targets, moves)
+            else:
+                self.addMoves(sq, targets, moves)
+
+        if self.enpassantPossible:
+            epSq = self.enpassantPossible[0] * 8 + self.enpassantPossible[1]
+            if allowed >> epSq & 1:
+                self.addEnpassantMoves(epSq, kingSq, checkers, targetMask, moves)
+        return moves
+
+    #en passant takes two pieces off one rank, so instead of the pin lines the king is checked for sliders on the
+    #occupancy after the capture
+    def addEnpassantMoves(self, epSq, kingSq, checkers, targetMask, moves):
+        bbs = self.bitboards
+        ally, enemy = ('w', 'b') if self.whiteToMove else ('b', 'w')
+        capturedBB = 1 << (epSq + 8 if self.whiteToMove else epSq - 8)
+        if checkers and not (targetMask >> epSq & 1 or checkers & capturedBB):
+            return
+        occupancy = self.occupancy['w'] | self.occupancy['b']
+        pawns = PAWN_ATTACKS[enemy][epSq] & bbs[ally + 'p']
+        while pawns:
+            bit = pawns & -pawns
+            pawns ^= bit
+            after = (occupancy ^ bit ^ capturedBB) | 1 << epSq
+            if not ((rookAttacks(kingSq, after) & (bbs[enemy + 'R'] | bbs[enemy + 'Q'])) or
+                    (bishopAttacks(kingSq, after) & (bbs[enemy + 'B'] | bbs[enemy + 'Q']))):
+                moves.append(ChessEngine.Move(divmod(bit.bit_length() - 1, 8), divmod(epSq, 8), self.board))
+
+    #castling, only called when the king is not in check
+    def addCastleMoves(self, kingSq, occupancy, allowed, moves):
+        if self.whiteToMove:
+            kingSide, queenSide, enemy = ChessEngine.CASTLE_WK, ChessEngine.CASTLE_WQ, 'b'
+        else:
+            kingSide, queenSide, enemy = ChessEngine.CASTLE_BK, ChessEngine.CASTLE_BQ, 'w'
+        start = divmod(kingSq, 8)
+        #the squares between king and rook must be empty, the two the king crosses must not be attacked
+        if self.castlingRights & kingSide and allowed >> (kingSq + 2) & 1 and not occupancy & (3 << (kingSq + 1)):
+            if not self.attackersOf(kingSq + 1, enemy, occupancy) and not self.attackersOf(kingSq + 2, enemy, occupancy):
+                moves.append(ChessEngine.Move(start, divmod(kingSq + 2, 8), self.board))
+        if self.castlingRights & queenSide and allowed >> (kingSq - 2) & 1 and not occupancy & (7 << (kingSq - 3)):
+            if not self.attackersOf(kingSq - 1, enemy, occupancy) and not self.attackersOf(kingSq - 2, enemy, occupancy):
+                moves.append(ChessEngine.Move(start, divmod(kingSq - 2, 8), self.board))
+
+    #the GameState methods below read the attack maps in the mailbox backend, here they are answered from the
+    #bitboards so the whole GameState API works on either backend
+    def checkForPinsAndChecks(self):
+        ally, enemy = ('w', 'b') if self.whiteToMove else ('b', 'w')
+        kingSq = self.bitboards[ally + 'K'].bit_length() - 1
+        checkers, checks, pinLines, pins = self.findPinsAndChecks(kingSq, ally, enemy)
+        return checkers != 0, pins, checks
+
+    def squareAttackedBy(self, r, c, color):
+        return self.attackersOf(r * 8 + c, color, self.occupancy['w'] | self.occupancy['b']) != 0
+
+    def getKingXrays(self, r, c, enemyColor):
+        bbs = self.bitboards
+        sliders = bbs[enemyColor + 'R'] | bbs[enemyColor + 'B'] | bbs[enemyColor + 'Q']
+        checkers = self.attackersOf(r * 8 + c, enemyColor, self.occupancy['w'] | self.occupancy['b']) & sliders
+        xrayed = []
+        while checkers:
+            bit = checkers & -checkers
+            checkers ^= bit
+            origin = bit.bit_length() - 1
+            xrayed.append((r + (r > origin // 8) - (r < origin // 8), c + (c > origin % 8) - (c < origin % 8)))
+        return xrayed
+
+    def getKingMoves(self, r, c, moves):
+        ally = self.board[r][c][0]
+        enemy = 'b' if ally == 'w' else 'w'
+        sq = r * 8 + c
+        occupancy = self.occupancy['w'] | self.occupancy['b']
+        withoutKing = occupancy ^ (1 << sq)
+        targets = KING_ATTACKS[sq] & ~self.occupancy[ally]
+        while targets:
+            bit = targets & -targets
+            targets ^= bit
+            end = bit.bit_length() - 1
+            if not self.attackersOf(end, enemy, withoutKing):
+                moves.append(ChessEngine.Move((r, c), divmod(end, 8), self.board))
+        if not self.attackersOf(sq, enemy, occupancy):
+            self.getCastleMoves(r, c, moves)
+
+    def getCastleMoves(self, r, c, moves):
+        castles = []
+        self.addCastleMoves(r * 8 + c, self.occupancy['w'] | self.occupancy['b'], FULL_BOARD, castles)
+        moves.extend(m for m in castles if m.pieceMoved == self.board[r][c])
+
+    #the staged generator's stages come out fully legal from the masks, so there is nothing left to check lazily
+    def getMoveConstraints(self):
+        ally, enemy = ('w', 'b') if self.whiteToMove else ('b', 'w')
+        kingSq = self.bitboards[ally + 'K'].bit_length() - 1
+        self.inCheck = self.attackersOf(kingSq, enemy, self.occupancy['w'] | self.occupancy['b']) != 0
+        return None
+
+    #captures, en passant and promotions
+    def getCaptureMoves(self):
+        allowed = self.occupancy['b' if self.whiteToMove else 'w'] | PROMOTION_RANKS
+        if self.enpassantPossible:
+            allowed |= 1 << (self.enpassantPossible[0] * 8 + self.enpassantPossible[1])
+        return [m for m in self.generateMoves(allowed) if m.pieceCaptured != "--" or m.promotionPiece is not None]
+
+    def getQuietMoves(self):
+        empty = ~(self.occupancy['w'] | self.occupancy['b']) & FULL_BOARD
+        return [m for m in self.generateMoves(empty) if not m.isEnpassantMove and m.promotionPiece is None]
+
+    def isLegalCandidate(self, move, constraints):
+        return True
+
+    def isLegal(self, move, constraints):
+        return self.matchesBoard(move) and move in self.generateMoves(1 << (move.endRow * 8 + move.endCol))
+
+    #pawn moves to the last rank, one move per promotion piece
+    def addPawnMoves(self, sq, targets, moves):
+        start = divmod(sq, 8)
+        board = self.board
+        while targets:
+            bit = targets & -targets
+            targets ^= bit
+            ChessEngine.appendMove(start, divmod(bit.bit_length() - 1, 8), board, moves)
+
+    def addMoves(self, sq, targets, moves):
+        start = divmod(sq, 8)
+        board = self.board
+        while targets:
+            bit = targets & -targets
+            targets ^= bit
+            moves.append(ChessEngine.Move(start, divmod(bit.bit_length() - 1, 8), board))
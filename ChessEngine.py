@@ -1,8 +1,226 @@
 # Description: This file contains the GameState class which represents the current state of the chess game. It contains the board configuration and the current player's turn.
 
+from array import array
+import contextlib
+import inspect
+import mmap
+import random
+import struct
+import sys
+import time
+
+PIECES = ["wp", "wR", "wN", "wB", "wQ", "wK", "bp", "bR", "bN", "bB", "bQ", "bK"]
+
+#binary position record, 32 bytes: occupancy bitboard (bit n = square n), the 4-bit codes of the occupied squares in
+#square order, flags (bit 0 set when black is to move), en-passant square (255 for none), halfmove clock,
+#fullmove number and two spare bytes
+POSITION_FORMAT = struct.Struct(">Q16sBBHHxx")
+POSITION_SIZE = POSITION_FORMAT.size
+
+#one character per piece as in FEN, "." for an empty square
+PIECE_CHARS = {"--": "."}
+PIECE_CHARS.update({piece: piece[1].upper() if piece[0] == 'w' else piece[1].lower() for piece in PIECES})
+CHAR_PIECES = {char: piece for piece, char in PIECE_CHARS.items()}
+
+#square index (row*8 + col) to its name, "a8" is 0 and "h1" is 63
+SQUARE_NAMES = [file + rank for rank in "87654321" for file in "abcdefgh"]
+
+#move tables, built once at import so the generators only iterate. targets are (row, col) tuples that go straight
+#into Move, and every table is indexed by square = row*8 + col
+DIRECTIONS = ((-1, 0), (0, -1), (1, 0), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1)) #orthogonal first, then diagonal
+DIRECTION_INDEX = {d: i for i, d in enumerate(DIRECTIONS)}
+KNIGHT_OFFSETS = ((-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1))
+
+
+def onBoard(r, c):
+    return 0 <= r < 8 and 0 <= c < 8
+
+
+def buildRay(r, c, d):
+    ray = []
+    endRow, endCol = r + d[0], c + d[1]
+    while onBoard(endRow, endCol):
+        ray.append((endRow, endCol))
+        endRow += d[0]
+        endCol += d[1]
+    return tuple(ray)
+
+
+#RAYS[sq][i] is the ordered ray from sq in DIRECTIONS[i], nearest square first
+RAYS = [tuple(buildRay(sq // 8, sq % 8, d) for d in DIRECTIONS) for sq in range(64)]
+#(direction, ray) pairs for each slider, skipping empty rays
+ROOK_RAYS = [tuple((d, RAYS[sq][i]) for i, d in enumerate(DIRECTIONS[:4]) if RAYS[sq][i]) for sq in range(64)]
+BISHOP_RAYS = [tuple((d, RAYS[sq][i + 4]) for i, d in enumerate(DIRECTIONS[4:]) if RAYS[sq][i + 4]) for sq in range(64)]
+QUEEN_RAYS = [ROOK_RAYS[sq] + BISHOP_RAYS[sq] for sq in range(64)]
+KNIGHT_TARGETS = [tuple((sq // 8 + m[0], sq % 8 + m[1]) for m in KNIGHT_OFFSETS if onBoard(sq // 8 + m[0], sq % 8 + m[1]))
+                  for sq in range(64)]
+KING_TARGETS = [tuple((sq // 8 + d[0], sq % 8 + d[1]) for d in DIRECTIONS if onBoard(sq // 8 + d[0], sq % 8 + d[1]))
+                for sq in range(64)]
+#pushes in order (single, then double from the starting rank) and (target, direction) pairs for captures
+PAWN_PUSHES = {
+    'w': [tuple((sq // 8 - i, sq % 8) for i in ((1, 2) if sq // 8 == 6 else (1,)) if sq // 8 - i >= 0) for sq in range(64)],
+    'b': [tuple((sq // 8 + i, sq % 8) for i in ((1, 2) if sq // 8 == 1 else (1,)) if sq // 8 + i < 8) for sq in range(64)],
+}
+PAWN_CAPTURES = {
+    color: [tuple(((sq // 8 + dr, sq % 8 + dc), (dr, dc)) for dc in (-1, 1) if onBoard(sq // 8 + dr, sq % 8 + dc))
+            for sq in range(64)]
+    for color, dr in (('w', -1), ('b', 1))
+}
+#the same targets as square indexes, for the attack maps
+ATTACKS_BY_STEP = {
+    'N': [tuple(t[0]*8 + t[1] for t in KNIGHT_TARGETS[sq]) for sq in range(64)],
+    'K': [tuple(t[0]*8 + t[1] for t in KING_TARGETS[sq]) for sq in range(64)],
+    'wp': [tuple(t[0][0]*8 + t[0][1] for t in PAWN_CAPTURES['w'][sq]) for sq in range(64)],
+    'bp': [tuple(t[0][0]*8 + t[0][1] for t in PAWN_CAPTURES['b'][sq]) for sq in range(64)],
+}
+SLIDER_RAYS = {'R': ROOK_RAYS, 'B': BISHOP_RAYS, 'Q': QUEEN_RAYS}
+
+#zobrist keys: a random 64-bit number for every piece on every square and one for black to move. the hash of a
+#position is the xor of the keys that apply, so a move changes it with a handful of xors. the seed is fixed so
+#hashes are the same in every process
+zobristRandom = random.Random(20240601)
+ZOBRIST_PIECES = {piece: [zobristRandom.getrandbits(64) for _ in range(64)] for piece in PIECES}
+ZOBRIST_BLACK_TO_MOVE = zobristRandom.getrandbits(64)
+ZOBRIST_PIECES["--"] = [0]*64 #so a square change can be hashed without checking for an empty square
+
+#castling rights are 4 bits, in FEN order
+CASTLE_WK, CASTLE_WQ, CASTLE_BK, CASTLE_BQ = 1, 2, 4, 8
+CASTLING_CHARS = (('K', CASTLE_WK), ('Q', CASTLE_WQ), ('k', CASTLE_BK), ('q', CASTLE_BQ))
+#the right, the king's square, the rook's square and the pieces that have to be there for it
+CASTLING_HOMES = ((CASTLE_WK, 60, 63, 'wK', 'wR'), (CASTLE_WQ, 60, 56, 'wK', 'wR'),
+                  (CASTLE_BK, 4, 7, 'bK', 'bR'), (CASTLE_BQ, 4, 0, 'bK', 'bR'))
+#the rights that survive a move from or to each square: moving the king or a rook, or capturing a rook, loses them
+CASTLING_MASKS = [15]*64
+for right, kingSq, rookSq, king, rook in CASTLING_HOMES:
+    CASTLING_MASKS[kingSq] &= ~right
+    CASTLING_MASKS[rookSq] &= ~right
+zobristCastlingBits = [zobristRandom.getrandbits(64) for _ in range(4)]
+ZOBRIST_CASTLING = [0]*16
+for rights in range(16):
+    for bit in range(4):
+        if rights >> bit & 1:
+            ZOBRIST_CASTLING[rights] ^= zobristCastlingBits[bit]
+ZOBRIST_EN_PASSANT = [zobristRandom.getrandbits(64) for _ in range(8)] #by file
+PROMOTION_PIECES = ('Q', 'R', 'B', 'N')
+PROMOTION_CODES = {None: 0, 'Q': 1, 'R': 2, 'B': 3, 'N': 4} #3 bits of Move.moveID
+
+#evaluation: material and piece square tables for the middlegame and the endgame, blended by the game phase (the
+#non-pawn material left on the board). GameState keeps both sums up to date in makeMove/undoMove
+MG_PIECE_VALUES = {'K': 0, 'Q': 900, 'R': 500, 'B': 330, 'N': 320, 'p': 100}
+EG_PIECE_VALUES = {'K': 0, 'Q': 900, 'R': 520, 'B': 330, 'N': 300, 'p': 120}
+PHASE_WEIGHTS = {'K': 0, 'Q': 4, 'R': 2, 'B': 1, 'N': 1, 'p': 0}
+MAX_PHASE = 24 #the phase of the start position
+
+#piece square tables from white's point of view, laid out like the board (row 0 is the 8th rank)
+MG_PIECE_SQUARE_TABLES = {
+    'p': [0, 0, 0, 0, 0, 0, 0, 0,
+          50, 50, 50, 50, 50, 50, 50, 50,
+          10, 10, 20, 30, 30, 20, 10, 10,
+          5, 5, 10, 25, 25, 10, 5, 5,
+          0, 0, 0, 20, 20, 0, 0, 0,
+          5, -5, -10, 0, 0, -10, -5, 5,
+          5, 10, 10, -20, -20, 10, 10, 5,
+          0, 0, 0, 0, 0, 0, 0, 0],
+    'N': [-50, -40, -30, -30, -30, -30, -40, -50,
+          -40, -20, 0, 0, 0, 0, -20, -40,
+          -30, 0, 10, 15, 15, 10, 0, -30,
+          -30, 5, 15, 20, 20, 15, 5, -30,
+          -30, 0, 15, 20, 20, 15, 0, -30,
+          -30, 5, 10, 15, 15, 10, 5, -30,
+          -40, -20, 0, 5, 5, 0, -20, -40,
+          -50, -40, -30, -30, -30, -30, -40, -50],
+    'B': [-20, -10, -10, -10, -10, -10, -10, -20,
+          -10, 0, 0, 0, 0, 0, 0, -10,
+          -10, 0, 5, 10, 10, 5, 0, -10,
+          -10, 5, 5, 10, 10, 5, 5, -10,
+          -10, 0, 10, 10, 10, 10, 0, -10,
+          -10, 10, 10, 10, 10, 10, 10, -10,
+          -10, 5, 0, 0, 0, 0, 5, -10,
+          -20, -10, -10, -10, -10, -10, -10, -20],
+    'R': [0, 0, 0, 0, 0, 0, 0, 0,
+          5, 10, 10, 10, 10, 10, 10, 5,
+          -5, 0, 0, 0, 0, 0, 0, -5,
+          -5, 0, 0, 0, 0, 0, 0, -5,
+          -5, 0, 0, 0, 0, 0, 0, -5,
+          -5, 0, 0, 0, 0, 0, 0, -5,
+          -5, 0, 0, 0, 0, 0, 0, -5,
+          0, 0, 0, 5, 5, 0, 0, 0],
+    'Q': [-20, -10, -10, -5, -5, -10, -10, -20,
+          -10, 0, 0, 0, 0, 0, 0, -10,
+          -10, 0, 5, 5, 5, 5, 0, -10,
+          -5, 0, 5, 5, 5, 5, 0, -5,
+          0, 0, 5, 5, 5, 5, 0, -5,
+          -10, 5, 5, 5, 5, 5, 0, -10,
+          -10, 0, 5, 0, 0, 0, 0, -10,
+          -20, -10, -10, -5, -5, -10, -10, -20],
+    'K': [-30, -40, -40, -50, -50, -40, -40, -30,
+          -30, -40, -40, -50, -50, -40, -40, -30,
+          -30, -40, -40, -50, -50, -40, -40, -30,
+          -30, -40, -40, -50, -50, -40, -40, -30,
+          -20, -30, -30, -40, -40, -30, -30, -20,
+          -10, -20, -20, -20, -20, -20, -20, -10,
+          20, 20, 0, 0, 0, 0, 20, 20,
+          20, 30, 10, 0, 0, 10, 30, 20],
+}
+#the endgame tables only differ for pawns, which gain value as they advance, and the king, which belongs in the centre
+EG_PIECE_SQUARE_TABLES = dict(MG_PIECE_SQUARE_TABLES)
+EG_PIECE_SQUARE_TABLES['p'] = [0, 0, 0, 0, 0, 0, 0, 0,
+                               80, 80, 80, 80, 80, 80, 80, 80,
+                               50, 50, 50, 50, 50, 50, 50, 50,
+                               30, 30, 30, 30, 30, 30, 30, 30,
+                               20, 20, 20, 20, 20, 20, 20, 20,
+                               10, 10, 10, 10, 10, 10, 10, 10,
+                               10, 10, 10, 10, 10, 10, 10, 10,
+                               0, 0, 0, 0, 0, 0, 0, 0]
+EG_PIECE_SQUARE_TABLES['K'] = [-50, -40, -30, -20, -20, -30, -40, -50,
+                               -30, -20, -10, 0, 0, -10, -20, -30,
+                               -30, -10, 20, 30, 30, 20, -10, -30,
+                               -30, -10, 30, 40, 40, 30, -10, -30,
+                               -30, -10, 30, 40, 40, 30, -10, -30,
+                               -30, -10, 20, 30, 30, 20, -10, -30,
+                               -30, -30, 0, 0, 0, 0, -30, -30,
+                               -50, -30, -30, -30, -30, -30, -30, -50]
+
+
+#value of a piece on each square from white's point of view: black pieces use the mirrored table and count negative.
+#the empty square is all zeros so captures need no special case
+def buildPieceScores(values, tables):
+    scores = {"--": [0]*64}
+    for piece in PIECES:
+        if piece[0] == 'w':
+            scores[piece] = [values[piece[1]] + tables[piece[1]][sq] for sq in range(64)]
+        else:
+            scores[piece] = [-values[piece[1]] - tables[piece[1]][(7 - sq // 8)*8 + sq % 8] for sq in range(64)]
+    return scores
+
+
+MG_SCORES = buildPieceScores(MG_PIECE_VALUES, MG_PIECE_SQUARE_TABLES)
+EG_SCORES = buildPieceScores(EG_PIECE_VALUES, EG_PIECE_SQUARE_TABLES)
+PIECE_PHASES = {piece: PHASE_WEIGHTS[piece[1]] for piece in PIECES}
+PIECE_PHASES["--"] = 0
 
 class GameState:
-    def __init__(self):
+    #the bitboard backend answers attack questions from its own bitboards and switches the attack maps off
+    tracksAttacks = True
+
+    #backend picks the position representation: "mailbox" is the 8x8 list below, "bitboard" keeps 64-bit integer
+    #bitboards alongside it and generates moves from precomputed attack tables (see ChessBitboard.py)
+    #transpositionTable is an optional TranspositionTable shared by everything that looks positions up by hash
+    #board, whiteToMove, castlingRights (CASTLE_* bits) and enpassantPossible (the (row, col) a pawn can capture en
+    #passant on, or ()) set up another position, they are used by the fromFen/fromBytes/fromSnapshot constructors.
+    #rights and en-passant squares the board can't back up are dropped
+    def __new__(cls, backend="mailbox", *args, **kwargs):
+        if cls is GameState and backend != "mailbox":
+            if backend != "bitboard":
+                raise ValueError("unknown backend: " + str(backend))
+            import ChessBitboard
+            cls = ChessBitboard.BitboardGameState
+        return super().__new__(cls)
+
+    def __init__(self, backend="mailbox", transpositionTable=None, board=None, whiteToMove=True, castlingRights=15,
+                 enpassantPossible=()):
+        self.backend = backend
+        self.transpositionTable = transpositionTable
         # Board is an 8x8 2D list, each element has 2 characters.
         # The first character represents the color of the piece, 'b' or 'w'.
         # The second character represents the type of the piece, 'K', 'Q', 'R', 'B', 'N', or 'p'.
@@ -16,30 +234,272 @@ class GameState:
             ["--", "--", "--", "--", "--", "--", "--", "--"],
             ["wp", "wp", "wp", "wp", "wp", "wp", "wp", "wp"],
             ["wR", "wN", "wB", "wQ", "wK", "wB", "wN", "wR"]
-        ]
+        ] if board is None else board
         
-        self.moveFunctions = {'p': self.getPawnMoves,
-                              'R': self.getRookMoves,
-                              'N': self.getKnightMoves,
-                              'B': self.getBishopMoves,
-                              'Q': self.getQueenMoves,
-                              'K': self.getKingMoves
+        #generator names, looked up on the class at call time so wrapped (instrumented) versions are always used
+        self.moveFunctions = {'p': 'getPawnMoves',
+                              'R': 'getRookMoves',
+                              'N': 'getKnightMoves',
+                              'B': 'getBishopMoves',
+                              'Q': 'getQueenMoves',
+                              'K': 'getKingMoves'
                               }
         
-        self.whiteToMove = True
+        self.whiteToMove = whiteToMove
         self.moveLog = []
+        #one undo record per move in moveLog: (piece captured, castling rights, en-passant square, halfmove clock),
+        #everything the move changed that the move itself can't give back
+        self.undoLog = []
+        self.castlingRights = castlingRights
+        self.enpassantPossible = enpassantPossible
+        self.halfmoveClock = 0 #plies since the last capture or pawn move
+        self.startFullmove = 1 #fullmove number of the position the move log starts from
         self.whiteKingLocation = (7,4)
         self.blackKingLocation = (0,4)
         self.inCheck = False
         self.pins = []
         self.checks = []
+        self.syncBoard()
+
+    #set up a position from a FEN string
+    @staticmethod
+    def fromFen(fen, backend="mailbox"):
+        fields = fen.split()
+        if not fields:
+            raise ValueError("empty FEN")
+        board = []
+        for rank in fields[0].split('/'):
+            row = []
+            for char in rank:
+                if char.isdigit():
+                    row.extend(["--"] * int(char))
+                elif char in CHAR_PIECES:
+                    row.append(CHAR_PIECES[char])
+                else:
+                    raise ValueError("bad FEN piece: " + char)
+            if len(row) != 8:
+                raise ValueError("bad FEN rank: " + rank)
+            board.append(row)
+        if len(board) != 8:
+            raise ValueError("FEN must have 8 ranks: " + fen)
+        castlingRights = 0
+        for char, right in CASTLING_CHARS:
+            if len(fields) > 2 and char in fields[2]:
+                castlingRights |= right
+        enpassantPossible = ()
+        if len(fields) > 3 and fields[3] != '-':
+            if fields[3] not in Move.squareIndex:
+                raise ValueError("bad FEN en-passant square: " + fields[3])
+            enpassantPossible = divmod(Move.squareIndex[fields[3]], 8)
+        gs = GameState(backend, board=board, whiteToMove=len(fields) < 2 or fields[1] == 'w',
+                       castlingRights=castlingRights, enpassantPossible=enpassantPossible)
+        gs.halfmoveClock = int(fields[4]) if len(fields) > 4 else 0
+        gs.startFullmove = int(fields[5]) if len(fields) > 5 else 1
+        return gs
+
+    def toFen(self):
+        ranks = []
+        for row in self.board:
+            rank = ""
+            empty = 0
+            for piece in row:
+                if piece == "--":
+                    empty += 1
+                else:
+                    if empty:
+                        rank += str(empty)
+                        empty = 0
+                    rank += PIECE_CHARS[piece]
+            if empty:
+                rank += str(empty)
+            ranks.append(rank)
+        castling = "".join(char for char, right in CASTLING_CHARS if self.castlingRights & right) or "-"
+        enpassant = SQUARE_NAMES[self.enpassantPossible[0]*8 + self.enpassantPossible[1]] if self.enpassantPossible \
+            else "-"
+        return "%s %s %s %s %d %d" % ("/".join(ranks), 'w' if self.whiteToMove else 'b', castling, enpassant,
+                                      self.getHalfmoveClock(), self.getFullmoveNumber())
+
+    #plies since the last capture or pawn move
+    def getHalfmoveClock(self):
+        return self.halfmoveClock
+
+    def getFullmoveNumber(self):
+        startedWithBlack = (len(self.moveLog) % 2 == 0) != self.whiteToMove
+        return self.startFullmove + (len(self.moveLog) + startedWithBlack) // 2
+
+    #the legal move for a move in standard algebraic notation ("Nf3", "exd5", "R1e2+"), ValueError if there is none
+    def moveFromSan(self, san):
+        text = san.rstrip('+#!?')
+        if text in ('O-O', 'O-O-O', '0-0', '0-0-0'):
+            endCol = 6 if len(text) == 3 else 2
+            for move in self.getValidMoves():
+                if move.isCastleMove and move.endCol == endCol:
+                    return move
+            raise ValueError("illegal SAN move: " + san)
+        pieceType = text[0] if text[0] in 'KQRBN' else 'p'
+        if pieceType != 'p':
+            text = text[1:]
+        text = text.replace('x', '').replace('=', '')
+        promotionPiece = None
+        if pieceType == 'p' and text and text[-1] in PROMOTION_PIECES: #"e8=Q", some files leave out the '='
+            promotionPiece = text[-1]
+            text = text[:-1]
+        endSq = Move.squareIndex.get(text[-2:])
+        if endSq is None:
+            raise ValueError("bad SAN move: " + san)
+        hint = text[:-2] #disambiguation: a file, a rank or both
+        candidates = []
+        for move in self.getValidMoves():
+            if move.pieceMoved[1] == pieceType and move.moveID >> 6 & 63 == endSq and \
+                    move.promotionPiece == promotionPiece:
+                start = SQUARE_NAMES[move.moveID & 63]
+                if all(char in start for char in hint):
+                    candidates.append(move)
+        if len(candidates) != 1:
+            raise ValueError(("ambiguous" if candidates else "illegal") + " SAN move: " + san)
+        return candidates[0]
+
+    #the position as a POSITION_SIZE byte record
+    def toBytes(self):
+        occupancy = 0
+        codes = []
+        for sq in range(64):
+            piece = self.board[sq // 8][sq % 8]
+            if piece != "--":
+                occupancy |= 1 << sq
+                codes.append(Move.pieceCodes[piece])
+        if len(codes) > 32:
+            raise ValueError("more than 32 pieces do not fit in a position record")
+        codes.extend([0] * (32 - len(codes)))
+        packed = bytes(codes[i] << 4 | codes[i + 1] for i in range(0, 32, 2))
+        flags = (0 if self.whiteToMove else 1) | self.castlingRights << 1
+        epSquare = self.enpassantPossible[0]*8 + self.enpassantPossible[1] if self.enpassantPossible else 255
+        return POSITION_FORMAT.pack(occupancy, packed, flags, epSquare, min(self.getHalfmoveClock(), 65535),
+                                    min(self.getFullmoveNumber(), 65535))
+
+    #read a position record straight out of a buffer (bytes, bytearray, memoryview or mmap) without copying it
+    @staticmethod
+    def fromBytes(buffer, offset=0, backend="mailbox"):
+        occupancy, packed, flags, epSquare, halfmove, fullmove = POSITION_FORMAT.unpack_from(buffer, offset)
+        squares = ["--"] * 64
+        codePieces = Move.codePieces
+        i = 0
+        while occupancy:
+            bit = occupancy & -occupancy
+            occupancy ^= bit
+            code = packed[i >> 1] >> 4 if i % 2 == 0 else packed[i >> 1] & 15
+            squares[bit.bit_length() - 1] = codePieces[code]
+            i += 1
+        gs = GameState(backend, board=[squares[r*8:r*8 + 8] for r in range(8)], whiteToMove=not flags & 1,
+                       castlingRights=flags >> 1 & 15, enpassantPossible=divmod(epSquare, 8) if epSquare < 64 else ())
+        gs.halfmoveClock = halfmove
+        gs.startFullmove = fullmove
+        return gs
+
+    #compact, cheaply picklable form of the position for sending to other processes: the board as a 64 character
+    #string, the side to move, the castling rights and the en-passant square. the generator table, attack maps and
+    #the move history are left behind
+    def getSnapshot(self):
+        return ("".join(PIECE_CHARS[piece] for row in self.board for piece in row), self.whiteToMove,
+                self.castlingRights, self.enpassantPossible)
+
+    @staticmethod
+    def fromSnapshot(snapshot, backend="mailbox"):
+        squares, whiteToMove, castlingRights, enpassantPossible = snapshot
+        return GameState(backend, board=[[CHAR_PIECES[char] for char in squares[r*8:r*8 + 8]] for r in range(8)],
+                         whiteToMove=whiteToMove, castlingRights=castlingRights, enpassantPossible=enpassantPossible)
+
+    #recompute everything derived from self.board, after the board has been set up directly
+    def syncBoard(self):
+        for r in range(8):
+            for c in range(8):
+                if self.board[r][c] == 'wK':
+                    self.whiteKingLocation = (r, c)
+                elif self.board[r][c] == 'bK':
+                    self.blackKingLocation = (r, c)
+        board = self.board
+        for right, kingSq, rookSq, king, rook in CASTLING_HOMES:
+            if board[kingSq // 8][kingSq % 8] != king or board[rookSq // 8][rookSq % 8] != rook:
+                self.castlingRights &= ~right
+        if self.enpassantPossible:
+            r, c = self.enpassantPossible
+            pawnRow, pawn = (r + 1, 'bp') if self.whiteToMove else (r - 1, 'wp')
+            if not 0 <= pawnRow < 8 or board[pawnRow][c] != pawn or \
+                    self.getEnpassantSquare(pawnRow, c, pawn) != self.enpassantPossible:
+                self.enpassantPossible = ()
+        self.zobristKey = self.computeZobristKey()
+        self.keyHistory = [self.zobristKey] #hash after every move in moveLog, for undo and repetition checks
+        self.computeScores()
+        if self.tracksAttacks:
+            self.buildAttackMaps()
         
-    #won't work for castling, pawn promotion, and en-passant
+    #full hash of the current position, makeMove keeps it up to date incrementally
+    def computeZobristKey(self):
+        key = 0 if self.whiteToMove else ZOBRIST_BLACK_TO_MOVE
+        key ^= ZOBRIST_CASTLING[self.castlingRights]
+        if self.enpassantPossible:
+            key ^= ZOBRIST_EN_PASSANT[self.enpassantPossible[1]]
+        for r in range(8):
+            for c in range(8):
+                if self.board[r][c] != "--":
+                    key ^= ZOBRIST_PIECES[self.board[r][c]][r*8 + c]
+        return key
+
+    #material and piece square sums from white's point of view and the game phase, makeMove/undoMove apply deltas
+    def computeScores(self):
+        self.mgScore = 0
+        self.egScore = 0
+        self.phase = 0
+        for r in range(8):
+            for c in range(8):
+                piece = self.board[r][c]
+                self.mgScore += MG_SCORES[piece][r*8 + c]
+                self.egScore += EG_SCORES[piece][r*8 + c]
+                self.phase += PIECE_PHASES[piece]
+
+    #static evaluation in centipawns for the side to move, the middlegame and endgame scores blended by the phase
+    def evaluate(self):
+        phase = min(self.phase, MAX_PHASE) #promotions can push the phase past the start position
+        score = (self.mgScore * phase + self.egScore * (MAX_PHASE - phase)) // MAX_PHASE
+        return score if self.whiteToMove else -score
+
+    #true if the current position has already occurred count - 1 times before (threefold repetition by default)
+    def isRepetition(self, count=3):
+        return self.keyHistory.count(self.zobristKey) >= count
+
+    #every move goes through the same list of square changes, so castling, en passant and promotion need no special
+    #case in the board, hash, score or attack map updates. the undo record keeps what the move can't give back by
+    #itself, undoMove restores from it without copying the board or recomputing anything
     def makeMove(self,move):
-        self.board[move.startRow][move.startCol] = "--"
-        self.board[move.endRow][move.endCol] = move.pieceMoved
+        changes = self.getSquareChanges(move, move.pieceCaptured)
+        self.undoLog.append((move.pieceCaptured, self.castlingRights, self.enpassantPossible, self.halfmoveClock))
+        self.setSquares(changes, False)
         self.moveLog.append(move) #log the move so we can undo it later
         self.whiteToMove = not self.whiteToMove #swap players
+        key = self.zobristKey ^ ZOBRIST_BLACK_TO_MOVE
+        for sq, before, after in changes:
+            key ^= ZOBRIST_PIECES[before][sq] ^ ZOBRIST_PIECES[after][sq]
+        startSq = move.startRow*8 + move.startCol
+        endSq = move.endRow*8 + move.endCol
+        castlingRights = self.castlingRights & CASTLING_MASKS[startSq] & CASTLING_MASKS[endSq]
+        key ^= ZOBRIST_CASTLING[self.castlingRights] ^ ZOBRIST_CASTLING[castlingRights]
+        self.castlingRights = castlingRights
+        if self.enpassantPossible:
+            key ^= ZOBRIST_EN_PASSANT[self.enpassantPossible[1]]
+        if move.pieceMoved[1] == 'p':
+            self.halfmoveClock = 0
+            if abs(move.endRow - move.startRow) == 2:
+                self.enpassantPossible = self.getEnpassantSquare(move.endRow, move.endCol, move.pieceMoved)
+                if self.enpassantPossible:
+                    key ^= ZOBRIST_EN_PASSANT[move.endCol]
+            else:
+                self.enpassantPossible = ()
+        else:
+            self.halfmoveClock = 0 if move.pieceCaptured != "--" else self.halfmoveClock + 1
+            self.enpassantPossible = ()
+        self.zobristKey = key
+        self.keyHistory.append(key)
+        self.updateScores(changes, 1)
         
         #update the king's location if needed
         if move.pieceMoved == 'wK':
@@ -50,18 +510,134 @@ class GameState:
     def undoMove(self):
         if len(self.moveLog) != 0: #make sure there is a move to undo
             move = self.moveLog.pop()
-            self.board[move.startRow][move.startCol] = move.pieceMoved
-            self.board[move.endRow][move.endCol] = move.pieceCaptured
+            pieceCaptured, self.castlingRights, self.enpassantPossible, self.halfmoveClock = self.undoLog.pop()
+            changes = self.getSquareChanges(move, pieceCaptured)
+            self.setSquares(changes, True)
             self.whiteToMove = not self.whiteToMove #switch turns back
+            self.keyHistory.pop()
+            self.zobristKey = self.keyHistory[-1]
+            self.updateScores(changes, -1)
         
             #update the king's location if needed   
             if move.pieceMoved == 'wK':
                 self.whiteKingLocation = (move.startRow, move.startCol)
             elif move.pieceMoved == 'bK':
                 self.blackKingLocation = (move.startRow, move.startCol)
-        
 
-            
+    #the squares a move changes as (square, piece before, piece after): the start and end squares, plus the captured
+    #pawn's square for en passant and the rook's two squares for castling
+    def getSquareChanges(self, move, pieceCaptured):
+        startSq = move.startRow*8 + move.startCol
+        endSq = move.endRow*8 + move.endCol
+        placed = move.pieceMoved if move.promotionPiece is None else move.pieceMoved[0] + move.promotionPiece
+        if move.isEnpassantMove:
+            return ((startSq, move.pieceMoved, "--"), (endSq, "--", placed),
+                    (move.startRow*8 + move.endCol, pieceCaptured, "--"))
+        if move.isCastleMove:
+            rook = move.pieceMoved[0] + 'R'
+            if move.endCol > move.startCol: #king side, the rook jumps from the h file to the f file
+                rookStart, rookEnd = startSq + 3, startSq + 1
+            else: #queen side, from the a file to the d file
+                rookStart, rookEnd = startSq - 4, startSq - 1
+            return ((startSq, move.pieceMoved, "--"), (endSq, "--", placed), (rookStart, rook, "--"),
+                    (rookEnd, "--", rook))
+        return ((startSq, move.pieceMoved, "--"), (endSq, pieceCaptured, placed))
+
+    #write the changes to the board, forwards or backwards, keeping the attack maps in step
+    def setSquares(self, changes, undo):
+        board = self.board
+        if self.tracksAttacks:
+            changed = [change[0] for change in changes]
+            affected = self.liftAttacks(changed)
+        for sq, before, after in changes:
+            board[sq // 8][sq % 8] = before if undo else after
+        if self.tracksAttacks:
+            self.dropAttacks(affected, changed)
+
+    #the en-passant square after a pawn double push to (row, col). it is only set when an enemy pawn stands next to
+    #the pawn, so positions with the same moves also get the same hash
+    def getEnpassantSquare(self, row, col, pawn):
+        enemyPawn = 'bp' if pawn == 'wp' else 'wp'
+        rank = self.board[row]
+        if (col > 0 and rank[col - 1] == enemyPawn) or (col < 7 and rank[col + 1] == enemyPawn):
+            return (row + 1 if pawn == 'wp' else row - 1, col)
+        return ()
+
+    #sign is 1 to apply a move's square changes to the evaluation sums and -1 to take them back
+    def updateScores(self, changes, sign):
+        for sq, before, after in changes:
+            self.mgScore += sign * (MG_SCORES[after][sq] - MG_SCORES[before][sq])
+            self.egScore += sign * (EG_SCORES[after][sq] - EG_SCORES[before][sq])
+            self.phase += sign * (PIECE_PHASES[after] - PIECE_PHASES[before])
+
+    #attack maps: for every square, the squares of the pieces attacking it and how many of them are white and black.
+    #makeMove and undoMove only recompute the pieces whose attacks go through the squares a move changes (the pieces
+    #on those squares and any slider that reached them), so checks and king safety become lookups instead of scans
+    def buildAttackMaps(self):
+        self.attackMap = {} #square of a piece: (color of the piece, squares it attacks)
+        self.attackedBy = [set() for _ in range(64)]
+        self.attackCounts = {'w': [0]*64, 'b': [0]*64}
+        for sq in range(64):
+            if self.board[sq // 8][sq % 8] != "--":
+                self.addAttacks(sq)
+
+    #squares attacked by the piece on sq, including squares of pieces it defends
+    def attacksFrom(self, sq):
+        r, c = divmod(sq, 8)
+        piece = self.board[r][c]
+        kind = piece[1]
+        if kind == 'p':
+            return ATTACKS_BY_STEP[piece][sq]
+        if kind == 'N' or kind == 'K':
+            return ATTACKS_BY_STEP[kind][sq]
+        targets = []
+        board = self.board
+        for d, ray in SLIDER_RAYS[kind][sq]:
+            for end in ray:
+                targets.append(end[0]*8 + end[1])
+                if board[end[0]][end[1]] != "--": #blocked, but the blocking square itself is attacked
+                    break
+        return targets
+
+    def addAttacks(self, sq):
+        color = self.board[sq // 8][sq % 8][0]
+        targets = self.attacksFrom(sq)
+        self.attackMap[sq] = (color, targets)
+        counts = self.attackCounts[color]
+        for t in targets:
+            counts[t] += 1
+            self.attackedBy[t].add(sq)
+
+    def removeAttacks(self, sq):
+        color, targets = self.attackMap.pop(sq)
+        counts = self.attackCounts[color]
+        for t in targets:
+            counts[t] -= 1
+            self.attackedBy[t].discard(sq)
+
+    #take off the attacks of every piece that a change on the given squares can affect, before the board changes
+    def liftAttacks(self, changed):
+        affected = set()
+        for sq in changed:
+            if sq in self.attackMap:
+                affected.add(sq)
+            for origin in self.attackedBy[sq]:
+                if self.board[origin // 8][origin % 8][1] in 'RBQ':
+                    affected.add(origin)
+        for sq in affected:
+            self.removeAttacks(sq)
+        return affected
+
+    #put the attacks back for the same pieces, after the board has changed
+    def dropAttacks(self, affected, changed):
+        for sq in affected.union(changed):
+            if self.board[sq // 8][sq % 8] != "--":
+                self.addAttacks(sq)
+
+    #true if the square is attacked by a piece of the given color
+    def squareAttackedBy(self, r, c, color):
+        return self.attackCounts[color][r*8 + c] > 0
+
     #all moves considering checks
 
 
@@ -75,44 +651,61 @@ class GameState:
                 pinDirection = (self.pins[i][2],self.pins[i][3])
                 self.pins.remove(self.pins[i])
                 break
-        
-        if self.whiteToMove: #white pawn moves
-            if self.board[r-1][c] == "--": #1 square pawn advance
-                if not piecePinned or pinDirection == (-1,0):
-                    moves.append(Move((r,c),(r-1,c),self.board))
-                    if r == 6 and self.board[r-2][c] == "--":  # 2 square pawn advance
-                        moves.append(Move((r,c),(r-2,c),self.board))
-            
-            #captures to the left
-            if c-1 >= 0:
-                if self.board[r-1][c-1][0] == 'b': #enemy piece to capture
-                    if not piecePinned or pinDirection == (-1,-1):
-                        moves.append(Move((r,c),(r-1,c-1),self.board))
-            #captures to the right
-            if c+1 <= 7:
-                if self.board[r-1][c+1][0] == 'b': #enemy piece to capture
-                    if not piecePinned or pinDirection == (-1,1):
-                        moves.append(Move((r,c),(r-1,c+1),self.board))
-                    
-        else:  # Black pawn moves
-            if self.board[r+1][c] == "--":  # 1 square pawn advance
-                if not piecePinned or pinDirection == (1,0):
-                    moves.append(Move((r, c), (r+1, c), self.board))
-                if r == 1 and self.board[r+2][c] == "--":  # 2 square pawn advance
-                   moves.append(Move((r, c), (r+2, c), self.board))
-
-            # Captures to the left
-            if c-1 >= 0:
-                if self.board[r+1][c-1][0] == 'w':  # Enemy piece to capture
-                    if not piecePinned or pinDirection == (1,-1):
-                        moves.append(Move((r, c), (r+1, c-1), self.board))
-            # Captures to the right
-            if c+1 <= 7:
-                if self.board[r+1][c+1][0] == 'w':  # Enemy piece to capture
-                    if not piecePinned or pinDirection == (1,1):
-                        moves.append(Move((r, c), (r+1, c+1), self.board))
 
-    
+        board = self.board
+        start = (r, c)
+        sq = r*8 + c
+        if self.whiteToMove:
+            allyColor, enemyColor = 'w', 'b'
+        else:
+            allyColor, enemyColor = 'b', 'w'
+        promotes = r == (1 if allyColor == 'w' else 6) #the next step reaches the last rank
+        if not piecePinned or pinDirection[1] == 0: #pinned along its file, it can still push
+            for end in PAWN_PUSHES[allyColor][sq]: #1 square advance, then 2 from the starting rank
+                if board[end[0]][end[1]] != "--":
+                    break
+                if promotes:
+                    appendMove(start, end, board, moves)
+                else:
+                    moves.append(Move(start, end, board))
+        for end, d in PAWN_CAPTURES[allyColor][sq]:
+            if board[end[0]][end[1]][0] == enemyColor: #enemy piece to capture
+                if not piecePinned or pinDirection == d:
+                    if promotes:
+                        appendMove(start, end, board, moves)
+                    else:
+                        moves.append(Move(start, end, board))
+            elif end == self.enpassantPossible:
+                move = Move(start, end, board)
+                if self.isEnpassantSafe(move):
+                    moves.append(move)
+
+    #en passant empties two squares of one rank at once, which the pin scan can't see (king and rook on the same
+    #rank as both pawns), so the move is tried on the board to see if the king is left in check
+    def isEnpassantSafe(self, move):
+        self.makeMove(move)
+        kingRow, kingCol = self.blackKingLocation if self.whiteToMove else self.whiteKingLocation
+        safe = not self.squareAttackedBy(kingRow, kingCol, 'w' if self.whiteToMove else 'b')
+        self.undoMove()
+        return safe
+
+    #get all the rook, bishop or queen moves along the given rays and add these moves to the list
+    def getSlidingMoves(self, r, c, rays, piecePinned, pinDirection, moves):
+        board = self.board
+        start = (r, c)
+        enemyColor = "b" if self.whiteToMove else "w"
+        for d, ray in rays:
+            if not piecePinned or pinDirection == d or pinDirection == (-d[0],-d[1]):
+                for end in ray:
+                    endPiece = board[end[0]][end[1]]
+                    if endPiece == "--": #empty space valid
+                        moves.append(Move(start, end, board))
+                    elif endPiece[0] == enemyColor: #enemy piece valid
+                        moves.append(Move(start, end, board))
+                        break
+                    else: #friendly piece invalid
+                        break
+
     #get all the rook moves for the rook located at row, col and add these moves to the list
     def getRookMoves(self, r, c, moves):
         piecePinned = False
@@ -124,45 +717,21 @@ class GameState:
                 if self.board[r][c][1] != 'Q': #can't remove queen from pin on rook moves, only remove it on bishop moves
                     self.pins.remove(self.pins[i])
                 break
-            
-        directions = [(-1, 0), (1, 0), (0, -1), (0, 1)]
-        enemyColor = "b" if self.whiteToMove else "w"
-        for d in directions:
-            for i in range(1, 8):
-                endRow = r + d[0] * i
-                endCol = c + d[1] * i
-                if 0 <= endRow < 8 and 0 <= endCol < 8:
-                    if not piecePinned or pinDirection == d or pinDirection == (-d[0],-d[1]):
-                        endPiece = self.board[endRow][endCol]
-                        if endPiece == "--": #empty space valid
-                            moves.append(Move((r, c), (endRow, endCol), self.board))
-                        elif endPiece[0] == enemyColor: #enemy piece valid
-                            moves.append(Move((r, c), (endRow, endCol), self.board))
-                            break
-                        else: #friendly piece invalid
-                            break
-                else: #off board invalid
-                    break
+        self.getSlidingMoves(r, c, ROOK_RAYS[r*8 + c], piecePinned, pinDirection, moves)
 
     #get all the knight moves for the knight located at row, col and add these moves to the list
     def getKnightMoves(self, r, c, moves):
-        piecePinned = False
         for i in range(len(self.pins)-1,-1,-1): #go through all the pins
             if self.pins[i][0] == r and self.pins[i][1] == c:
-                piecePinned = True
                 self.pins.remove(self.pins[i])
-                break
-            
-        knightMoves = [(-2, -1), (-1, -2), (1, -2), (2, -1), (2, 1), (1, 2), (-1, 2), (-2, 1)]
+                return #a pinned knight can never move
+
+        board = self.board
+        start = (r, c)
         allyColor = "w" if self.whiteToMove else "b"
-        for m in knightMoves:
-            endRow = r + m[0]
-            endCol = c + m[1]
-            if 0 <= endRow < 8 and 0 <= endCol < 8:
-                if not piecePinned:
-                    endPiece = self.board[endRow][endCol]
-                    if endPiece[0] != allyColor:
-                        moves.append(Move((r, c), (endRow, endCol), self.board))
+        for end in KNIGHT_TARGETS[r*8 + c]:
+            if board[end[0]][end[1]][0] != allyColor:
+                moves.append(Move(start, end, board))
 
     #get all the bishop moves for the bishop located at row, col and add these moves to the list
     def getBishopMoves(self, r, c, moves):
@@ -174,25 +743,7 @@ class GameState:
                 pinDirection = (self.pins[i][2],self.pins[i][3])
                 self.pins.remove(self.pins[i])
                 break
-            
-        directions = [(-1, -1), (-1, 1), (1, -1), (1, 1)]
-        enemyColor = "b" if self.whiteToMove else "w"
-        for d in directions:
-            for i in range(1, 8):
-                endRow = r + d[0] * i
-                endCol = c + d[1] * i
-                if 0 <= endRow < 8 and 0 <= endCol < 8:
-                    if not piecePinned or pinDirection == d or pinDirection == (-d[0],-d[1]):
-                        endPiece = self.board[endRow][endCol]
-                        if endPiece == "--":
-                            moves.append(Move((r, c), (endRow, endCol), self.board))
-                        elif endPiece[0] == enemyColor:
-                            moves.append(Move((r, c), (endRow, endCol), self.board))
-                            break
-                        else:
-                            break
-                else:
-                    break
+        self.getSlidingMoves(r, c, BISHOP_RAYS[r*8 + c], piecePinned, pinDirection, moves)
  
     #get all the queen moves for the queen located at row, col and add these moves to the list
     def getQueenMoves(self, r, c, moves):
@@ -201,34 +752,66 @@ class GameState:
 
     #get all the king moves for the king located at row, col and add these moves to the list
     def getKingMoves(self, r, c, moves):
-        rowMoves = [-1, -1, -1, 0, 0, 1, 1, 1]
-        colMoves = [-1, 0, 1, -1, 1, -1, 0, 1]
-        allyColor = "w" if self.whiteToMove else "b"
-        for i in range(8):
-            endRow = r + rowMoves[i]
-            endCol = c + colMoves[i]
-            if 0 <= endRow < 8 and 0 <= endCol < 8:
-                endPiece = self.board[endRow][endCol]
-                if endPiece[0] != allyColor: #not an ally piece (empty or enemy piece)
-                    #place king on end square and check for checks
-                    if allyColor == "w":
-                        self.whiteKingLocation = (endRow, endCol)
-                    else:
-                        self.blackKingLocation = (endRow, endCol)
-                    inCheck, pins, checks = self.checkForPinsAndChecks()
-                    if not inCheck:
-                        moves.append(Move((r, c), (endRow, endCol), self.board))    
-                        #place king back on original location
-                    if allyColor == "w":
-                        self.whiteKingLocation = (r, c)
-                    else:
-                        self.blackKingLocation = (r, c)
+        allyColor = self.board[r][c][0]
+        enemyColor = "b" if allyColor == "w" else "w"
+        enemyAttacks = self.attackCounts[enemyColor]
+        xrayed = self.getKingXrays(r, c, enemyColor)
+        board = self.board
+        for end in KING_TARGETS[r*8 + c]:
+            if board[end[0]][end[1]][0] != allyColor: #not an ally piece (empty or enemy piece)
+                if enemyAttacks[end[0]*8 + end[1]] == 0 and end not in xrayed:
+                    moves.append(Move((r, c), end, board))
+        if enemyAttacks[r*8 + c] == 0:
+            self.getCastleMoves(r, c, moves)
+
+    #castling: the right is still there (so the king and rook are on their squares), the squares between them are
+    #empty and the king is not in check and doesn't pass through or land on an attacked square
+    def getCastleMoves(self, r, c, moves):
+        board = self.board
+        if board[r][c][0] == 'w':
+            kingSide, queenSide, enemyColor = CASTLE_WK, CASTLE_WQ, 'b'
+        else:
+            kingSide, queenSide, enemyColor = CASTLE_BK, CASTLE_BQ, 'w'
+        enemyAttacks = self.attackCounts[enemyColor]
+        sq = r*8 + c
+        if self.castlingRights & kingSide and board[r][c + 1] == "--" and board[r][c + 2] == "--" and \
+                enemyAttacks[sq + 1] == 0 and enemyAttacks[sq + 2] == 0:
+            moves.append(Move((r, c), (r, c + 2), board))
+        if self.castlingRights & queenSide and board[r][c - 1] == "--" and board[r][c - 2] == "--" and \
+                board[r][c - 3] == "--" and enemyAttacks[sq - 1] == 0 and enemyAttacks[sq - 2] == 0:
+            moves.append(Move((r, c), (r, c - 2), board))
+
+    #a slider giving check still attacks the square behind the king once the king steps back along its line
+    def getKingXrays(self, r, c, enemyColor):
+        xrayed = []
+        for origin in self.attackedBy[r*8 + c]:
+            piece = self.board[origin // 8][origin % 8]
+            if piece[0] == enemyColor and piece[1] in 'RBQ':
+                dr = (r > origin // 8) - (r < origin // 8)
+                dc = (c > origin % 8) - (c < origin % 8)
+                xrayed.append((r + dr, c + dc))
+        return xrayed
+
+    #squares a piece other than the king can move to to answer a single check: capture the checker or block the line
+    def getCheckBlockSquares(self, kingRow, kingCol, check):
+        checkRow = check[0]
+        checkCol = check[1]
+        if self.board[checkRow][checkCol][1] == 'N':
+            return [(checkRow, checkCol)]
+        validSquares = []
+        for i in range(1, 8):
+            validSquare = (kingRow + check[2] * i, kingCol + check[3] * i)
+            validSquares.append(validSquare)
+            if validSquare[0] == checkRow and validSquare[1] == checkCol:
+                break
+        return validSquares
 
 
+    #checks come straight from the attack maps. pins are found from the enemy sliders lined up with the king, walking
+    #only the squares between the two
     def checkForPinsAndChecks(self):
         pins = [] # squares where the allied pinned piece is and direction it's pinned from
         checks = [] # squares where enemy is applying a check
-        inCheck = False
         if self.whiteToMove:
             enemyColor = 'b'
             allyColor = 'w'
@@ -239,59 +822,206 @@ class GameState:
             allyColor = 'b'
             startRow = self.blackKingLocation[0]
             startCol = self.blackKingLocation[1]
-        # check outwards from king for pins and checks, keep track of pins
-        directions = ((-1, 0), (0, -1), (1, 0), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1))
-        for j in range(len(directions)):
-            d = directions[j]
-            possiblePin = ()
-            for i in range(1, 8):
-                endRow = startRow + d[0] * i
-                endCol = startCol + d[1] * i
-                if 0 <= endRow < 8 and 0 <= endCol < 8:
-                    endPiece = self.board[endRow][endCol]
-                    if endPiece[0] == allyColor and endPiece[1] != "K":  # ally piece, not king
-                        if possiblePin == ():  # first pinned piece found
-                            possiblePin = (endRow, endCol, d[0], d[1])
-                        else:
-                            break  # stop checking in this direction
-                        
-                    elif endPiece[0] == enemyColor:  # enemy piece
-                        type = endPiece[1]
-                        # 5 possibilities in this complex conditional
-                        # 1. orthogonally away from king and piece is a rook
-                        # 2. diagonally away from king and piece is a bishop
-                        # 3. 1 square away diagonally from king and piece is a pawn
-                        # 4. any direction and piece is a queen
-                        # 5. any direction 1 square away and piece is a king
-                        if (0 <= j <= 3 and type == 'R') or \
-                              (4 <= j <= 7 and type == 'B') or \
-                              (i == 1 and type == 'p' and ((enemyColor == 'w' and 6 <= j <= 7) or (enemyColor == 'b' and 4 <= j <= 5))) or \
-                              (type == 'Q') or (i == 1 and type == 'K'):
-                            if possiblePin == (): # no piece blocking, so check is still valid
-                                inCheck = True
-                                checks.append((endRow, endCol, d[0], d[1]))
-                                break
-                            else:  # there is a piece blocking so pin
-                                pins.append(possiblePin)
-                                break
-                        else:  # enemy piece not applying check
-                            break
+
+        for origin in self.attackedBy[startRow*8 + startCol]:
+            if self.attackMap[origin][0] == enemyColor:
+                endRow, endCol = divmod(origin, 8)
+                if self.board[endRow][endCol][1] == 'N':
+                    checks.append((endRow, endCol, endRow - startRow, endCol - startCol))
                 else:
-                    break #off board
-                
-        # check for knight checks
-        knightMoves = ((-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1))
-        for m in knightMoves:
-            endRow = startRow + m[0]
-            endCol = startCol + m[1]
-            if 0 <= endRow < 8 and 0 <= endCol < 8:
-                endPiece = self.board[endRow][endCol]
-                if endPiece[0] == enemyColor and endPiece[1] == 'N':  # enemy knight attacking the king
-                    inCheck = True
-                    checks.append((endRow, endCol, m[0], m[1]))
+                    checks.append((endRow, endCol, (endRow > startRow) - (endRow < startRow),
+                                   (endCol > startCol) - (endCol < startCol)))
+        inCheck = len(checks) > 0
+
+        for origin, (color, targets) in self.attackMap.items():
+            if color != enemyColor:
+                continue
+            type = self.board[origin // 8][origin % 8][1]
+            rowDiff = origin // 8 - startRow
+            colDiff = origin % 8 - startCol
+            # 1. orthogonally away from king and piece is a rook or queen
+            # 2. diagonally away from king and piece is a bishop or queen
+            if rowDiff == 0 or colDiff == 0:
+                if type != 'R' and type != 'Q':
+                    continue
+            elif abs(rowDiff) == abs(colDiff):
+                if type != 'B' and type != 'Q':
+                    continue
+            else:
+                continue
+            d = ((rowDiff > 0) - (rowDiff < 0), (colDiff > 0) - (colDiff < 0))
+            possiblePin = ()
+            ray = RAYS[startRow*8 + startCol][DIRECTION_INDEX[d]]
+            for i in range(max(abs(rowDiff), abs(colDiff)) - 1): #squares between the king and the slider
+                end = ray[i]
+                endPiece = self.board[end[0]][end[1]]
+                if endPiece != "--":
+                    if endPiece[0] == allyColor and possiblePin == (): # first pinned piece found
+                        possiblePin = (end[0], end[1], d[0], d[1])
+                    else: # a second piece or an enemy piece, nothing is pinned on this line
+                        possiblePin = ()
+                        break
+            if possiblePin != ():
+                pins.append(possiblePin)
 
         return inCheck, pins, checks
        
+    #moves one stage at a time in the order a search wants to try them: the hash move, captures by MVV-LVA, the killer
+    #moves, then the quiet moves sorted by quietOrder (highest first). a stage is only generated when the caller gets
+    #to it and a move is only checked for legality right before it is handed out, so a node that cuts off on its
+    #first move or two never pays for the rest. capturesOnly stops after the captures, except in check where every
+    #evasion is generated. inCheck is set as soon as this is called, before the first move is asked for
+    def getStagedMoves(self, hashMove=None, killers=(), quietOrder=None, capturesOnly=False):
+        constraints = self.getMoveConstraints()
+        return self.generateStagedMoves(constraints, hashMove, killers, quietOrder, capturesOnly and not self.inCheck)
+
+    def generateStagedMoves(self, constraints, hashMove, killers, quietOrder, capturesOnly):
+        tried = [] #moves already handed out, they are skipped when a later stage generates them again
+        if hashMove is not None and (not capturesOnly or hashMove.pieceCaptured != "--") and \
+                self.isLegal(hashMove, constraints):
+            tried.append(hashMove)
+            yield hashMove
+        captures = self.getCaptureMoves()
+        captures.sort(key=mvvLva, reverse=True)
+        for move in captures:
+            if move not in tried and self.isLegalCandidate(move, constraints):
+                yield move
+        if capturesOnly:
+            return
+        for move in killers: #promotions came out with the captures
+            if move is not None and move.pieceCaptured == "--" and move.promotionPiece is None and \
+                    move not in tried and self.isLegal(move, constraints):
+                tried.append(move)
+                yield move
+        quiets = self.getQuietMoves()
+        if quietOrder is not None:
+            quiets.sort(key=quietOrder, reverse=True)
+        for move in quiets:
+            if move not in tried and self.isLegalCandidate(move, constraints):
+                yield move
+
+    #what legality depends on in this position: (pinned squares and their pin directions, the squares that answer a
+    #single check or None, the squares behind the king a checking slider x-rays, number of checks). the staged
+    #generator keeps its own copy because the search overwrites the pins and checks of the game state below this node
+    def getMoveConstraints(self):
+        self.inCheck, self.pins, self.checks = self.checkForPinsAndChecks()
+        if self.whiteToMove:
+            kingRow, kingCol = self.whiteKingLocation
+        else:
+            kingRow, kingCol = self.blackKingLocation
+        pinDirections = {(pin[0], pin[1]): (pin[2], pin[3]) for pin in self.pins}
+        blockSquares = self.getCheckBlockSquares(kingRow, kingCol, self.checks[0]) if len(self.checks) == 1 else None
+        xrayed = self.getKingXrays(kingRow, kingCol, 'b' if self.whiteToMove else 'w') if self.inCheck else []
+        return pinDirections, blockSquares, xrayed, len(self.checks)
+
+    #pseudo-legal captures and promotions, straight from the attack maps: every piece of ours attacking an enemy
+    #piece, en passant, and pawn pushes to the last rank
+    def getCaptureMoves(self):
+        board = self.board
+        allyColor, enemyColor = ('w', 'b') if self.whiteToMove else ('b', 'w')
+        attackMap = self.attackMap
+        moves = []
+        for target, (color, targets) in attackMap.items():
+            if color == enemyColor and board[target // 8][target % 8][1] != 'K':
+                end = divmod(target, 8)
+                for origin in self.attackedBy[target]:
+                    if attackMap[origin][0] == allyColor:
+                        appendMove(divmod(origin, 8), end, board, moves)
+        if self.enpassantPossible:
+            r, c = self.enpassantPossible
+            for origin in self.attackedBy[r*8 + c]:
+                if board[origin // 8][origin % 8] == allyColor + 'p':
+                    moves.append(Move(divmod(origin, 8), self.enpassantPossible, board))
+        lastRank, pawnRow = (0, 1) if allyColor == 'w' else (7, 6)
+        for c in range(8):
+            if board[lastRank][c] == "--" and board[pawnRow][c] == allyColor + 'p':
+                appendMove((pawnRow, c), (lastRank, c), board, moves)
+        return moves
+
+    #pseudo-legal quiet moves: pawn pushes short of the last rank, the empty squares every other piece of ours
+    #attacks, and castling
+    def getQuietMoves(self):
+        board = self.board
+        allyColor = 'w' if self.whiteToMove else 'b'
+        moves = []
+        for origin, (color, targets) in self.attackMap.items():
+            if color != allyColor:
+                continue
+            start = divmod(origin, 8)
+            if board[start[0]][start[1]][1] == 'p':
+                for end in PAWN_PUSHES[allyColor][origin]:
+                    if board[end[0]][end[1]] != "--" or end[0] == 0 or end[0] == 7:
+                        break
+                    moves.append(Move(start, end, board))
+            else:
+                for target in targets:
+                    end = divmod(target, 8)
+                    if board[end[0]][end[1]] == "--":
+                        moves.append(Move(start, end, board))
+        kingRow, kingCol = self.whiteKingLocation if allyColor == 'w' else self.blackKingLocation
+        if self.attackCounts['b' if allyColor == 'w' else 'w'][kingRow*8 + kingCol] == 0:
+            self.getCastleMoves(kingRow, kingCol, moves)
+        return moves
+
+    #true if the move's pieces are where it expects them: its own piece on the start square, to move, and the piece
+    #it captures (or an empty square) where the capture happens. moves from another position fail this
+    def matchesBoard(self, move):
+        board = self.board
+        piece = board[move.startRow][move.startCol]
+        if piece != move.pieceMoved or piece[0] != ('w' if self.whiteToMove else 'b'):
+            return False
+        if move.pieceCaptured[0] == piece[0] or move.pieceCaptured[1] == 'K':
+            return False
+        if move.isEnpassantMove:
+            return board[move.endRow][move.endCol] == "--" and board[move.startRow][move.endCol] == move.pieceCaptured
+        return board[move.endRow][move.endCol] == move.pieceCaptured
+
+    #the capture and quiet lists are pseudo-legal, each move is checked when its turn comes
+    def isLegalCandidate(self, move, constraints):
+        return self.isLegal(move, constraints)
+
+    #true if a move from anywhere (hash table, killer slot) is legal here, from the attack maps and the constraints
+    def isLegal(self, move, constraints):
+        if not self.matchesBoard(move):
+            return False
+        board = self.board
+        r, c = move.startRow, move.startCol
+        piece = move.pieceMoved
+        allyColor = piece[0]
+        startSq = r*8 + c
+        endSq = move.endRow*8 + move.endCol
+        end = (move.endRow, move.endCol)
+        if move.isCastleMove:
+            castles = []
+            if self.attackCounts['b' if allyColor == 'w' else 'w'][startSq] == 0:
+                self.getCastleMoves(r, c, castles)
+            return move in castles
+        if move.isEnpassantMove:
+            return end == self.enpassantPossible and startSq in self.attackedBy[endSq] and self.isEnpassantSafe(move)
+        if piece[1] == 'p' and move.pieceCaptured == "--":
+            for push in PAWN_PUSHES[allyColor][startSq]:
+                if board[push[0]][push[1]] != "--":
+                    return False
+                if push == end:
+                    break
+            else:
+                return False
+        elif startSq not in self.attackedBy[endSq]:
+            return False
+        pinDirections, blockSquares, xrayed, checkCount = constraints
+        if piece[1] == 'K':
+            return self.attackCounts['b' if allyColor == 'w' else 'w'][endSq] == 0 and end not in xrayed
+        if checkCount > 1:
+            return False
+        if (r, c) in pinDirections:
+            if piece[1] == 'N':
+                return False
+            pin = pinDirections[(r, c)]
+            d = ((move.endRow > r) - (move.endRow < r), (move.endCol > c) - (move.endCol < c))
+            if d != pin and d != (-pin[0], -pin[1]):
+                return False
+        return blockSquares is None or end in blockSquares
+
     def getAllPossibleMoves(self):
         moves = []
         for r in range(len(self.board)):
@@ -299,10 +1029,27 @@ class GameState:
                 turn = self.board[r][c][0]
                 if (turn == 'w' and self.whiteToMove) or (turn == 'b' and not self.whiteToMove):
                     piece = self.board[r][c][1]
-                    self.moveFunctions[piece](r,c,moves)
+                    getattr(self, self.moveFunctions[piece])(r,c,moves)
         return moves
        
+    #all legal moves in the current position. with a transposition table the list is generated once per position
+    #and reused when the position comes back (undo, transpositions)
     def getValidMoves(self):
+        tt = self.transpositionTable
+        if tt is not None:
+            entry = tt.probe(self.zobristKey)
+            if entry is not None and entry.moves is not None:
+                self.inCheck = entry.inCheck
+                self.checks = list(entry.checks)
+                self.pins = []
+                decode = Move.decode
+                return [decode(code) for code in entry.moves]
+        moves = self.generateValidMoves()
+        if tt is not None:
+            tt.storeMoves(self.zobristKey, moves, self.inCheck, self.checks)
+        return moves
+
+    def generateValidMoves(self):
         moves = []
         self.inCheck, self.pins, self.checks = self.checkForPinsAndChecks()
         if self.whiteToMove:
@@ -314,43 +1061,153 @@ class GameState:
         
         if self.inCheck:
             if len(self.checks) == 1:
-                moves = self.getAllPossibleMoves()
-                check = self.checks[0]
-                checkRow = check[0]
-                checkCol = check[1]
-                pieceChecking = self.board[checkRow][checkCol]
-                validSquares = [] # squares that the king can move to
-                
-                if pieceChecking[1] == 'N':
-                    validSquares = [(checkRow, checkCol)]
-                else:
-                    for i in range(1, 8):
-                        validSquare = (kingRow + check[2] * i, kingCol + check[3] * i)
-                        validSquares.append(validSquare)
-                        if validSquare[0] == checkRow and validSquare[1] == checkCol:
-                            break
+                validSquares = self.getCheckBlockSquares(kingRow, kingCol, self.checks[0])
                 # get rid of any moves that don't get the king out of check or move into check
-                for i in range(len(moves) - 1, -1, -1):
-                    if moves[i].pieceMoved[1] != 'K':
-                        if not (moves[i].endRow, moves[i].endCol) in validSquares:
-                            moves.remove(moves[i])
+                #en passant was already tried on the board, it may take the checking pawn off a square not in the list
+                moves = [m for m in self.getAllPossibleMoves()
+                         if m.pieceMoved[1] == 'K' or m.isEnpassantMove or (m.endRow, m.endCol) in validSquares]
             else: #double check, king has to move
                 self.getKingMoves(kingRow, kingCol, moves)        
         else:
             moves = self.getAllPossibleMoves()
-        
-        # Check if any move leaves the king in check
-        for i in range(len(moves) - 1, -1, -1):
-            self.makeMove(moves[i])
-            self.whiteToMove = not self.whiteToMove
-            if self.inCheck:
-                moves.remove(moves[i])
-            self.whiteToMove = not self.whiteToMove
-            self.undoMove()
-            
+        #no make/undo pass is needed: pinned pieces stay on their pin line, check evasions were filtered above and
+        #the king only steps to squares the attack maps show as safe
         return moves
     
+#add a move to the list, or one move per promotion piece when it is a pawn reaching the last rank
+def appendMove(start, end, board, moves):
+    if end[0] == 0 or end[0] == 7:
+        if board[start[0]][start[1]][1] == 'p':
+            for piece in PROMOTION_PIECES:
+                moves.append(Move(start, end, board, piece))
+            return
+    moves.append(Move(start, end, board))
+
+
+#most valuable victim, least valuable attacker. a promotion counts the piece it promotes to as won
+def mvvLva(move):
+    score = -MG_PIECE_VALUES[move.pieceMoved[1]]
+    if move.pieceCaptured != "--":
+        score += MG_PIECE_VALUES[move.pieceCaptured[1]] * 10
+    if move.promotionPiece is not None:
+        score += MG_PIECE_VALUES[move.promotionPiece] * 10
+    return score
+
+
+#write positions to a file of POSITION_SIZE byte records
+def writePositionFile(path, states):
+    with open(path, "wb") as f:
+        for gs in states:
+            f.write(gs.toBytes())
+
+
+#memory-map a file of position records and yield them one at a time as POSITION_SIZE bytes objects, starting at
+#record start. the file is never read into memory
+def readPositionRecords(path, start=0):
+    with open(path, "rb") as f:
+        if f.seek(0, 2) == 0: #an empty file can't be mapped
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for offset in range(start * POSITION_SIZE, len(data) - POSITION_SIZE + 1, POSITION_SIZE):
+                yield data[offset:offset + POSITION_SIZE]
+
+
+#one GameState per record of a position file
+def readPositionFile(path, backend="mailbox", start=0):
+    for record in readPositionRecords(path, start):
+        yield GameState.fromBytes(record, 0, backend)
+
+
+class TTEntry():
+    __slots__ = ('key', 'depth', 'score', 'flag', 'bestMove', 'moves', 'inCheck', 'checks', 'generation')
+
+    def __init__(self, key):
+        self.key = key
+        self.depth = -1 #no search result stored yet
+        self.score = 0
+        self.flag = TranspositionTable.EXACT
+        self.bestMove = None
+        self.moves = None
+        self.inCheck = False
+        self.checks = ()
+        self.generation = 0
+
+
+#fixed size hash table of positions keyed by zobrist hash. each slot holds the legal move list of the position and
+#the result of the deepest search done on it. when two positions land on the same slot the new one replaces the old
+#one if the old one is from an earlier search (generation) or was searched less deeply
+class TranspositionTable():
+    EXACT = 0 #score is exact
+    LOWER = 1 #score is a lower bound (the search failed high)
+    UPPER = 2 #score is an upper bound (the search failed low)
+    #measured cost of one slot with a cached move list (tracemalloc over a filled table, 30-40 moves per position),
+    #used to turn the memory budget into a size
+    ENTRY_BYTES = 400
+
+    def __init__(self, sizeMB=16):
+        self.size = max(1, int(sizeMB * 1024 * 1024) // self.ENTRY_BYTES)
+        self.table = [None] * self.size
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.table = [None] * self.size
+        self.hits = 0
+        self.misses = 0
+
+    #call before every new search so entries from older searches become the first to go
+    def newSearch(self):
+        self.generation += 1
+
+    def probe(self, key):
+        entry = self.table[key % self.size]
+        if entry is not None and entry.key == key:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        return None
+
+    #the entry for key, making room for it in its slot if the replacement policy allows
+    def entryFor(self, key, depth):
+        index = key % self.size
+        entry = self.table[index]
+        if entry is None or (entry.key != key and (entry.generation != self.generation or depth >= entry.depth)):
+            entry = TTEntry(key)
+            self.table[index] = entry
+        elif entry.key != key:
+            return None
+        entry.generation = self.generation
+        return entry
+
+    def store(self, key, depth, score, flag, bestMove=None):
+        entry = self.entryFor(key, depth)
+        if entry is not None and depth >= entry.depth:
+            entry.depth = depth
+            entry.score = score
+            entry.flag = flag
+            if bestMove is not None or entry.bestMove is None:
+                entry.bestMove = bestMove
+
+    #the moves are kept as Move.encode() codes, 4 bytes each instead of a Move object each, and decoded on a hit
+    def storeMoves(self, key, moves, inCheck, checks):
+        entry = self.entryFor(key, 0)
+        if entry is not None:
+            entry.moves = array('I', [move.encode() for move in moves])
+            entry.inCheck = inCheck
+            entry.checks = tuple(checks)
+
+    #fraction of the slots in use, sampled from the start of the table
+    def usage(self, sample=1000):
+        sample = min(sample, self.size)
+        return sum(1 for e in self.table[:sample] if e is not None) / sample
+
+
 class Move():
+    #moves are created by the million during search and perft, so they carry no per-instance __dict__. moveID packs
+    #the start and end squares (6 bits each) and the promotion piece (3 bits) and is used for equality and hashing
+    __slots__ = ('startRow', 'startCol', 'endRow', 'endCol', 'pieceMoved', 'pieceCaptured', 'promotionPiece',
+                 'isEnpassantMove', 'isCastleMove', 'moveID')
 
     # maps keys to values
     # key : value
@@ -360,15 +1217,35 @@ class Move():
     filesToCols = {"a": 0, "b": 1, "c": 2, "d": 3,
                    "e": 4, "f": 5, "g": 6, "h": 7}
     colsToFiles = {v: k for k, v in filesToCols.items()}
+    squareNames = SQUARE_NAMES
+    squareIndex = {name: sq for sq, name in enumerate(SQUARE_NAMES)}
+    codePieces = ["--"] + PIECES #4-bit code of a piece, 0 is empty
+    pieceCodes = {piece: code for code, piece in enumerate(codePieces)}
+    codePromotions = (None,) + PROMOTION_PIECES #3-bit promotion field of moveID, 0 is no promotion
     
-    def __init__(self,startSq,endSq,board):
-        self.startRow = startSq[0]
-        self.startCol = startSq[1]
-        self.endRow = endSq[0]
-        self.endCol = endSq[1]
-        self.pieceMoved = board[self.startRow][self.startCol]
-        self.pieceCaptured = board[self.endRow][self.endCol]
-        self.moveID = self.startRow*1000 + self.startCol*100 + self.endRow*10 + self.endCol #unique id for each move
+    #special moves are recognised from the board: a pawn reaching the last rank promotes (to a queen unless
+    #promotionPiece says otherwise), a pawn stepping diagonally onto an empty square captures en passant and a king
+    #moving two squares castles
+    def __init__(self,startSq,endSq,board,promotionPiece='Q'):
+        self.startRow, self.startCol = startRow, startCol = startSq
+        self.endRow, self.endCol = endRow, endCol = endSq
+        self.pieceMoved = pieceMoved = board[startRow][startCol]
+        self.pieceCaptured = board[endRow][endCol]
+        self.promotionPiece = None
+        self.isEnpassantMove = False
+        self.isCastleMove = False
+        moveID = (startRow*8 + startCol) | (endRow*8 + endCol) << 6 #unique id for each move
+        kind = pieceMoved[1]
+        if kind == 'p':
+            if endRow == 0 or endRow == 7:
+                self.promotionPiece = promotionPiece
+                moveID |= PROMOTION_CODES[promotionPiece] << 12
+            elif startCol != endCol and self.pieceCaptured == "--":
+                self.isEnpassantMove = True
+                self.pieceCaptured = 'bp' if pieceMoved == 'wp' else 'wp'
+        elif kind == 'K' and (endCol - startCol == 2 or startCol - endCol == 2):
+            self.isCastleMove = True
+        self.moveID = moveID
         
     
     #overriding the equals method
@@ -376,10 +1253,231 @@ class Move():
         if isinstance(other,Move):
             return self.moveID == other.moveID
         return False
+
+    def __hash__(self):
+        return self.moveID
+
+    #the whole move as one int: moveID (15 bits) | en passant << 15 | piece moved << 16 | piece captured << 20
+    def encode(self):
+        return self.moveID | self.isEnpassantMove << 15 | self.pieceCodes[self.pieceMoved] << 16 | \
+            self.pieceCodes[self.pieceCaptured] << 20
+
+    #rebuild a move from encode(), no board needed
+    @staticmethod
+    def decode(code):
+        move = Move.__new__(Move)
+        move.startRow, move.startCol = divmod(code & 63, 8)
+        move.endRow, move.endCol = divmod(code >> 6 & 63, 8)
+        move.pieceMoved = Move.codePieces[code >> 16 & 15]
+        move.pieceCaptured = Move.codePieces[code >> 20 & 15]
+        move.promotionPiece = Move.codePromotions[code >> 12 & 7]
+        move.isEnpassantMove = bool(code >> 15 & 1)
+        move.isCastleMove = move.pieceMoved[1] == 'K' and abs(move.endCol - move.startCol) == 2
+        move.moveID = code & 32767
+        return move
+
+    #the move for a getChessNotation() string ("e2e4", "e7e8n") on the given board
+    @staticmethod
+    def fromChessNotation(notation, board):
+        start = Move.squareIndex[notation[0:2]]
+        end = Move.squareIndex[notation[2:4]]
+        return Move(divmod(start, 8), divmod(end, 8), board, notation[4:5].upper() or 'Q')
     
     def getChessNotation(self):
         #making to real chess notation
-        return self.getRankFile(self.startRow,self.startCol) + self.getRankFile(self.endRow,self.endCol)
+        notation = self.squareNames[self.moveID & 63] + self.squareNames[self.moveID >> 6 & 63]
+        return notation + self.promotionPiece.lower() if self.promotionPiece else notation
     
     def getRankFile(self,r,c):
         return self.colsToFiles[c] + self.rowsToRanks[r]
+
+
+#instrumentation. nothing is measured until enableStats wraps the methods below with counting and timing versions,
+#disableStats puts the originals back, so a normal run pays nothing for it. times include the calls a function
+#makes, getValidMoves contains generateValidMoves which contains checkForPinsAndChecks and the piece generators.
+INSTRUMENTED_METHODS = ("getValidMoves", "generateValidMoves", "checkForPinsAndChecks", "getAllPossibleMoves",
+                        "getPawnMoves", "getRookMoves", "getKnightMoves", "getBishopMoves", "getQueenMoves",
+                        "getKingMoves", "makeMove", "undoMove", "getStagedMoves", "generateStagedMoves",
+                        "getCaptureMoves", "getQuietMoves", "isLegalCandidate", "isLegal", "generateMoves")
+STATS = {} #name: [calls, seconds]
+#candidate moves that went through a legality check, and how many of them it threw away. the check is either the
+#filter pass of generateValidMoves or isLegalCandidate/isLegal in the staged generator
+PRUNING = [0, 0]
+legalityDepth = [0] #isLegalCandidate calls isLegal, only the outer call is counted
+instrumentedOriginals = [] #(class, name, original function) of everything enableStats replaced
+
+
+def timedFunction(name, function):
+    entry = STATS.setdefault(name, [0, 0.0])
+    perfCounter = time.perf_counter
+
+    def timed(*args, **kwargs):
+        start = perfCounter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            entry[0] += 1
+            entry[1] += perfCounter() - start
+    timed.__wrapped__ = function
+    return timed
+
+
+#a generator does its work when it is resumed, not when it is called, so every resume is timed. a call is counted
+#once however many moves the caller takes
+def timedGenerator(name, function):
+    entry = STATS.setdefault(name, [0, 0.0])
+    perfCounter = time.perf_counter
+
+    def timed(*args, **kwargs):
+        entry[0] += 1
+        start = perfCounter()
+        generator = function(*args, **kwargs)
+        try:
+            for item in generator:
+                entry[1] += perfCounter() - start
+                yield item
+                start = perfCounter()
+            entry[1] += perfCounter() - start
+        finally:
+            generator.close()
+    timed.__wrapped__ = function
+    return timed
+
+
+#the filter pass of generateValidMoves: candidates are counted when getAllPossibleMoves returns them, the ones
+#missing from the legal list were pruned
+def pruningFunction(name, function):
+    timed = timedFunction(name, function)
+    candidates = STATS.setdefault("pseudoLegalMoves", [0, 0.0])
+
+    def counted(self):
+        before = candidates[0]
+        moves = timed(self)
+        if candidates[0] != before:
+            PRUNING[0] += candidates[0] - before
+            PRUNING[1] += candidates[0] - before - len(moves)
+        return moves
+    counted.__wrapped__ = function
+    return counted
+
+
+def countingFunction(function):
+    candidates = STATS.setdefault("pseudoLegalMoves", [0, 0.0])
+
+    def counting(self):
+        moves = function(self)
+        candidates[0] += len(moves)
+        return moves
+    counting.__wrapped__ = function
+    return counting
+
+
+#the lazy legality checks of the staged generator: every move checked is a candidate, every false one was pruned
+def legalityFunction(name, function):
+    timed = timedFunction(name, function)
+
+    def checked(self, move, constraints):
+        if legalityDepth[0]:
+            return timed(self, move, constraints)
+        legalityDepth[0] = 1
+        try:
+            legal = timed(self, move, constraints)
+        finally:
+            legalityDepth[0] = 0
+        PRUNING[0] += 1
+        if not legal:
+            PRUNING[1] += 1
+        return legal
+    checked.__wrapped__ = function
+    return checked
+
+
+def enableStats():
+    if instrumentedOriginals:
+        return
+    import ChessBitboard #so the backend's overrides are wrapped before the first bitboard GameState exists
+    classes = [GameState] + GameState.__subclasses__()
+    for cls in classes:
+        for name in INSTRUMENTED_METHODS:
+            if name not in cls.__dict__:
+                continue
+            function = cls.__dict__[name]
+            label = name if cls is GameState else cls.__name__ + "." + name #overrides often call the base version
+            if name == "generateValidMoves":
+                wrapper = pruningFunction(label, function)
+            elif name == "getAllPossibleMoves":
+                wrapper = timedFunction(label, countingFunction(function))
+            elif name in ("isLegalCandidate", "isLegal"):
+                wrapper = legalityFunction(label, function)
+            elif inspect.isgeneratorfunction(function):
+                wrapper = timedGenerator(label, function)
+            else:
+                wrapper = timedFunction(label, function)
+            instrumentedOriginals.append((cls, name, function))
+            setattr(cls, name, wrapper)
+    instrumentedOriginals.append((Move, "__init__", Move.__init__))
+    Move.__init__ = timedFunction("Move", Move.__init__)
+
+
+def disableStats():
+    while instrumentedOriginals:
+        cls, name, function = instrumentedOriginals.pop()
+        setattr(cls, name, function)
+
+
+def resetStats():
+    for entry in STATS.values():
+        entry[0] = 0
+        entry[1] = 0.0
+    PRUNING[0] = PRUNING[1] = 0
+    legalityDepth[0] = 0
+
+
+#{name: {"calls", "seconds"}} for every instrumented function that was called, plus the pruning rate of the legality
+#checks
+def getStats():
+    stats = {name: {"calls": calls, "seconds": seconds} for name, (calls, seconds) in STATS.items()
+             if calls and name != "pseudoLegalMoves"}
+    stats["pruning"] = {"candidates": PRUNING[0], "pruned": PRUNING[1],
+                        "rate": PRUNING[1] / PRUNING[0] if PRUNING[0] else 0.0}
+    return stats
+
+
+#flat report, slowest first
+def formatStats(stats=None):
+    stats = getStats() if stats is None else dict(stats)
+    pruning = stats.pop("pruning")
+    lines = ["%-40s %12s %12s %14s" % ("function", "calls", "seconds", "us per call")]
+    for name, entry in sorted(stats.items(), key=lambda item: -item[1]["seconds"]):
+        lines.append("%-40s %12d %12.4f %14.2f" % (name, entry["calls"], entry["seconds"],
+                                                   entry["seconds"] / entry["calls"] * 1e6))
+    lines.append("legality checks: %d candidate moves, %d pruned (%.2f%%)" % (pruning["candidates"],
+                                                                              pruning["pruned"], pruning["rate"] * 100))
+    return "\n".join(lines)
+
+
+#measure the code run inside the block: with profile=None the counters above are switched on and a flat report is
+#written to output at the end, with profile="cprofile" cProfile runs as well and its report follows, sorted by sort.
+#yields the live STATS dictionary
+@contextlib.contextmanager
+def instrumented(profile=None, output=sys.stderr, sort="cumulative", limit=30):
+    resetStats()
+    enableStats()
+    profiler = None
+    if profile == "cprofile":
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif profile is not None:
+        raise ValueError("unknown profile: " + str(profile))
+    try:
+        yield STATS
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        disableStats()
+        if output is not None:
+            output.write(formatStats() + "\n")
+            if profiler is not None:
+                import pstats
+                pstats.Stats(profiler, stream=output).sort_stats(sort).print_stats(limit)
@@ -1,42 +1,140 @@
 #main driver file. handling user input and displaying the current GameState object
 
+import os
+import queue
+import threading
+
 import pygame as p
 import ChessEngine
+import ChessSearch
 
 WIDTH = HEIGHT = 512
 DIMENSION = 8
 SQ_SIZE = HEIGHT // DIMENSION
-MAX_FPS = 15
 IMAGES = {}
+HIGHLIGHTS = {} #translucent square overlays, made by loadImages
+ATLAS_PATH = "images/cache/pieces_%d.png" #all 12 pieces scaled to one square size, side by side
+BOARD_COLORS = [p.Color(222, 184, 135), p.Color(139, 69, 19)]
+HIGHLIGHT_COLORS = {"selected": p.Color(255, 255, 0, 110), "lastMove": p.Color(120, 200, 255, 80)}
+ENGINE_EVENT = p.USEREVENT + 1 #progress and results of the engine thread
+AI_TIME = 2.0 #seconds the computer thinks about a move
+HINT_TIME = 1.0
 
-#loading images
+#loading images. the scaled pieces are cached as one atlas image, so later starts load a single small file instead
+#of loading and scaling every PNG. the atlas is rebuilt when a PNG is newer or the square size changed
 def loadImages():
     pieces = ["wp", "wR", "wN", "wB", "wQ", "wK", "bp", "bR", "bN", "bB", "bQ", "bK"]
-    for piece in pieces:
-        IMAGES[piece] = p.transform.scale(p.image.load("images/" + piece + ".png"), (SQ_SIZE, SQ_SIZE))
+    path = ATLAS_PATH % SQ_SIZE
+    atlas = None
+    try:
+        if os.path.getmtime(path) >= max(os.path.getmtime("images/" + piece + ".png") for piece in pieces):
+            atlas = p.image.load(path)
+    except (OSError, p.error):
+        pass
+    if atlas is None or atlas.get_size() != (SQ_SIZE * len(pieces), SQ_SIZE):
+        atlas = p.Surface((SQ_SIZE * len(pieces), SQ_SIZE), p.SRCALPHA)
+        for i, piece in enumerate(pieces):
+            atlas.blit(p.transform.scale(p.image.load("images/" + piece + ".png"), (SQ_SIZE, SQ_SIZE)), (i*SQ_SIZE, 0))
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            p.image.save(atlas, path)
+        except (OSError, p.error): #read-only install, scale them again next time
+            pass
+    atlas = atlas.convert_alpha()
+    for i, piece in enumerate(pieces):
+        IMAGES[piece] = atlas.subsurface(p.Rect(i*SQ_SIZE, 0, SQ_SIZE, SQ_SIZE))
+    for name, color in HIGHLIGHT_COLORS.items():
+        HIGHLIGHTS[name] = p.Surface((SQ_SIZE, SQ_SIZE), p.SRCALPHA)
+        HIGHLIGHTS[name].fill(color)
     # Note: we can access an image by saying 'IMAGES['wp']'
     # Additional functionality can be added here if needed
-    
+
+
+#runs searches on a background thread so the window keeps drawing and taking input while the engine thinks. the
+#thread searches a copy of the position and posts every finished depth and the final result as ENGINE_EVENT events.
+#every request gets a job number and the event loop ignores events of jobs it has moved on from
+class EngineThread():
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.job = 0
+        self.stopEvent = threading.Event() #stop token of the latest job
+        self.transpositionTable = ChessEngine.TranspositionTable(16) #kept between moves, only one search uses it
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    #think about the current position, kind is "move" for a computer move or "hint". returns the job number
+    def start(self, gs, kind, timeLimit):
+        self.cancel()
+        self.stopEvent = threading.Event()
+        self.jobs.put((self.job, self.stopEvent, gs.getSnapshot(), gs.backend, kind, timeLimit))
+        return self.job
+
+    #drop the running job, it stops within a few hundred nodes and its events are ignored
+    def cancel(self):
+        self.job += 1
+        self.stopEvent.set() #every job has its own event, so this can't stop the next one
+
+    def run(self):
+        while True:
+            job, stopEvent, snapshot, backend, kind, timeLimit = self.jobs.get()
+            if stopEvent.is_set():
+                continue
+            gs = ChessEngine.GameState.fromSnapshot(snapshot, backend)
+            result = ChessSearch.Searcher(self.transpositionTable).search(
+                gs, timeLimit=timeLimit, onIteration=lambda result: self.post(job, kind, result, False),
+                stopEvent=stopEvent)
+            self.post(job, kind, result, True)
+
+    def post(self, job, kind, result, done):
+        p.event.post(p.event.Event(ENGINE_EVENT, job=job, kind=kind, done=done, depth=result.depth,
+                                   score=result.score, pv=[m.getChessNotation() for m in result.pv],
+                                   bestMove=result.bestMove.getChessNotation() if result.bestMove else None))
+
+
 def main():
     p.init()
     screen = p.display.set_mode((WIDTH, HEIGHT))
-    clock = p.time.Clock()
-    screen.fill(p.Color("white"))
-    gs = ChessEngine.GameState()
+    boardSurface = p.Surface((WIDTH, HEIGHT)) #the empty board, drawn once and copied from
+    drawBoard(boardSurface)
+    shown = [None] * (DIMENSION * DIMENSION) #what every square shows on screen, only changed squares are redrawn
+    gs = ChessEngine.GameState(transpositionTable=ChessEngine.TranspositionTable(16)) #reuses move lists on undo
     validMoves = gs.getValidMoves()
     moveMade = False #flag variable for when a move is made
+    engine = EngineThread()
+    computerColors = set() #colors the computer plays, 'e' hands the side to move over to it or takes it back
+    p.display.set_caption("Chess")
     
     loadImages() #only do this once, before the while loop
     running = True
     sqSelected = () #no square is selected, keep track of the last click of the user (tuple: (row, col))
     playerClicks = [] #keep track of player clicks (two tuples: [(6, 4), (4, 4)])
     while running:
-        for e in p.event.get():
+        for e in [p.event.wait()] + p.event.get(): #sleep until there is something to do
             if e.type == p.QUIT:
                 running = False
+
+            elif e.type == p.WINDOWEXPOSED: #the window was covered or restored, draw everything again
+                shown = [None] * (DIMENSION * DIMENSION)
             
+            #engine handlers
+            elif e.type == ENGINE_EVENT:
+                if e.job != engine.job: #the position changed since this job was started
+                    continue
+                if not e.done:
+                    p.display.set_caption("%s depth %d score %d pv %s" % ("thinking" if e.kind == "move" else "hint",
+                                                                         e.depth, e.score, " ".join(e.pv)))
+                elif e.kind == "hint":
+                    p.display.set_caption("hint: %s (depth %d score %d)" % (e.bestMove, e.depth, e.score))
+                elif e.bestMove is not None:
+                    move = ChessEngine.Move.fromChessNotation(e.bestMove, gs.board)
+                    if move in validMoves:
+                        gs.makeMove(validMoves[validMoves.index(move)])
+                        moveMade = True
+
             #mouse handlers
             elif e.type == p.MOUSEBUTTONDOWN:
+                if ('w' if gs.whiteToMove else 'b') in computerColors:
+                    continue #the computer is thinking about this move
                 location = p.mouse.get_pos() #(x, y) location of the mouse
                 col = location[0]//SQ_SIZE
                 row = location[1]//SQ_SIZE
@@ -47,10 +145,11 @@ def main():
                     sqSelected = (row, col)
                     playerClicks.append(sqSelected) #append for both 1st and 2nd clicks
                 if len(playerClicks) == 2: #after 2nd click
-                    move = ChessEngine.Move(playerClicks[0], playerClicks[1], gs.board)
+                    move = ChessEngine.Move(playerClicks[0], playerClicks[1], gs.board) #pawns promote to a queen
                     print(move.getChessNotation())
                     if move in validMoves:
-                        gs.makeMove(move)
+                        engine.cancel() #a hint for the old position is no use any more
+                        gs.makeMove(validMoves[validMoves.index(move)]) #the generated move knows its special rules
                         moveMade = True
                         sqSelected = () #reset user clicks
                         playerClicks = [] #reset user clicks
@@ -60,38 +159,69 @@ def main():
             #key handlers
             elif e.type == p.KEYDOWN:
                 if e.key == p.K_z and (p.key.get_mods() & p.KMOD_CTRL): #undo when 'CTRL + z' is pressed
+                    engine.cancel()
                     gs.undoMove()
+                    #take the computer's reply back too, or it would play it again straight away
+                    while gs.moveLog and len(computerColors) == 1 and \
+                            ('w' if gs.whiteToMove else 'b') in computerColors:
+                        gs.undoMove()
+                    moveMade = True
+                elif e.key == p.K_e: #the computer plays the side to move, or stops playing it
+                    computerColors ^= {'w' if gs.whiteToMove else 'b'}
+                    engine.cancel()
                     moveMade = True
+                elif e.key == p.K_h and validMoves and ('w' if gs.whiteToMove else 'b') not in computerColors:
+                    engine.start(gs, "hint", HINT_TIME) #ask the engine for a hint
+                    p.display.set_caption("hint: thinking")
         
         if moveMade:
             validMoves = gs.getValidMoves()
             moveMade = False
+            if not validMoves:
+                p.display.set_caption("checkmate" if gs.inCheck else "stalemate")
+            elif ('w' if gs.whiteToMove else 'b') in computerColors:
+                engine.start(gs, "move", AI_TIME)
+                p.display.set_caption("thinking")
+            else:
+                p.display.set_caption("Chess")
             
-        drawGameState(screen, gs)
-        clock.tick(MAX_FPS)
-        p.display.flip()
-
-#draw the squares on the board
-def drawGameState(screen, gs):
-    drawBoard(screen) #draw squares on the board
-    drawPieces(screen, gs.board) #draw pieces on top of those squares
-    
+        rects = drawGameState(screen, boardSurface, gs, sqSelected, shown)
+        if rects:
+            p.display.update(rects) #only the squares that changed
+
+#redraw the squares whose piece or highlight changed since the last call and return their rects. a square is the
+#board copied from boardSurface, the highlight of the selected square or the last move, then the piece
+def drawGameState(screen, boardSurface, gs, sqSelected, shown):
+    highlights = {}
+    if gs.moveLog:
+        lastMove = gs.moveLog[-1]
+        highlights[(lastMove.startRow, lastMove.startCol)] = "lastMove"
+        highlights[(lastMove.endRow, lastMove.endCol)] = "lastMove"
+    if sqSelected:
+        highlights[sqSelected] = "selected"
+    rects = []
+    for r in range(DIMENSION):
+        for c in range(DIMENSION):
+            look = (gs.board[r][c], highlights.get((r, c)))
+            if shown[r*DIMENSION + c] == look:
+                continue
+            shown[r*DIMENSION + c] = look
+            rect = p.Rect(c*SQ_SIZE, r*SQ_SIZE, SQ_SIZE, SQ_SIZE)
+            screen.blit(boardSurface, rect, rect)
+            if look[1] is not None:
+                screen.blit(HIGHLIGHTS[look[1]], rect)
+            if look[0] != "--": #not an empty square
+                screen.blit(IMAGES[look[0]], rect)
+            rects.append(rect)
+    return rects
+
 
 #draw the squares on the board. the top left square is always light
 def drawBoard(screen):
-    colors = [p.Color(222, 184, 135), p.Color(139, 69, 19)]
     for r in range(DIMENSION):
         for c in range(DIMENSION):
-            color = colors[((r+c) % 2)]
+            color = BOARD_COLORS[((r+c) % 2)]
             p.draw.rect(screen, color, p.Rect(c*SQ_SIZE, r*SQ_SIZE, SQ_SIZE, SQ_SIZE))
-            
-#draw the pieces on the board using the current GameState's board
-def drawPieces(screen, board):
-    for r in range(DIMENSION):
-        for c in range(DIMENSION):
-            piece = board[r][c]
-            if piece != "--": #not an empty square
-                screen.blit(IMAGES[piece], p.Rect(c*SQ_SIZE, r*SQ_SIZE, SQ_SIZE, SQ_SIZE))
 
 
 if __name__ == "__main__":
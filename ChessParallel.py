@@ -0,0 +1,182 @@
+# Description: multi-core perft and search. The work is split at the root: every legal root move becomes one job for
+# a ProcessPoolExecutor, the position travels as a GameState snapshot, and the results are merged in root move order
+# so the output does not depend on which worker finished first.
+#
+# usage: python ChessParallel.py perft --depth 5 --workers 8
+#        python ChessParallel.py search --fen "<fen>" --depth 5 --workers 8
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import ChessEngine
+import ChessPerft
+import ChessSearch
+
+searchIds = itertools.count() #tells the workers when a new search starts
+
+
+#the position after one root move, rebuilt inside a worker
+def childPosition(snapshot, backend, notation):
+    gs = ChessEngine.GameState.fromSnapshot(snapshot, backend)
+    gs.makeMove(ChessEngine.Move.fromChessNotation(notation, gs.board))
+    return gs
+
+
+def perftWorker(snapshot, backend, notation, depth):
+    return ChessPerft.perft(childPosition(snapshot, backend, notation), depth)
+
+
+#search state of a worker process: one Searcher, and so one transposition table, killer and history table, per
+#process, kept across root moves and iterations the way the serial search keeps them across its whole tree
+workerSearcher = None
+workerSearchId = None #the search the searcher was last prepared for
+
+
+def initSearchWorker(ttSizeMB):
+    global workerSearcher, workerSearchId
+    workerSearcher = ChessSearch.Searcher(ttSizeMB=ttSizeMB)
+    workerSearchId = None
+
+
+#fixed depth search of one root move with the window (alpha, beta) seen from the root. returns (score for the side
+#to move at the root, pv as notation, nodes, finished) where finished is False if the time ran out
+def searchWorker(snapshot, backend, notation, depth, alpha, beta, searchId, deadline, maxDepth, ttSizeMB):
+    global workerSearchId
+    if workerSearcher is None: #a pool passed in by the caller was not started with initSearchWorker
+        initSearchWorker(ttSizeMB)
+    searcher = workerSearcher
+    if workerSearchId != searchId:
+        searcher.prepare(deadline, maxDepth=maxDepth)
+        workerSearchId = searchId
+    gs = childPosition(snapshot, backend, notation)
+    gs.transpositionTable = searcher.tt
+    nodes = searcher.nodes
+    try:
+        score, pv = searcher.negamax(gs, depth, -beta, -alpha, 1)
+    except ChessSearch.SearchTimeout:
+        return 0, [], searcher.nodes - nodes, False
+    return -score, [notation] + [m.getChessNotation() for m in pv], searcher.nodes - nodes, True
+
+
+def rootNotations(gs):
+    return [m.getChessNotation() for m in gs.getValidMoves()]
+
+
+#perft split across processes, returns (total nodes, {root move: nodes}) with the root moves in generation order
+def parallelPerft(gs, depth, workers=None, executor=None):
+    if depth <= 1:
+        counts = ChessPerft.divide(gs, depth) if depth == 1 else {}
+        return (sum(counts.values()) if depth == 1 else 1), counts
+    snapshot = gs.getSnapshot()
+    notations = rootNotations(gs)
+    pool = executor or ProcessPoolExecutor(workers)
+    try:
+        futures = [pool.submit(perftWorker, snapshot, gs.backend, n, depth - 1) for n in notations]
+        counts = {n: f.result() for n, f in zip(notations, futures)}
+    finally:
+        if executor is None:
+            pool.shutdown()
+    return sum(counts.values()), counts
+
+
+#root split search with iterative deepening. every iteration searches the best move of the last one first with a
+#full window, then the other root moves in parallel with a null window around its score: they only have to show
+#they are no better, which costs about as much as the cut-offs of a serial search. a move that fails high is searched
+#again with an open window and becomes the best move if it really is better. ties go to the earlier root move. the
+#transposition tables belong to the workers, so scores can differ slightly with the number of workers
+def parallelSearch(gs, maxDepth=4, timeLimit=None, workers=None, onIteration=None, ttSizeMB=16, executor=None):
+    start = time.perf_counter()
+    deadline = start + timeLimit if timeLimit is not None else None
+    moves = gs.getValidMoves()
+    if not moves:
+        score = -ChessSearch.MATE_SCORE if gs.inCheck else 0
+        return ChessSearch.SearchResult(None, score, 0, [], 0, time.perf_counter() - start)
+    snapshot = gs.getSnapshot()
+    notations = [m.getChessNotation() for m in moves]
+    searchId = (os.getpid(), next(searchIds))
+    pool = executor or ProcessPoolExecutor(workers, initializer=initSearchWorker, initargs=(ttSizeMB,))
+    result = None
+    totalNodes = 0
+    try:
+        for depth in range(1, maxDepth + 1):
+            def submit(index, alpha, beta):
+                return pool.submit(searchWorker, snapshot, gs.backend, notations[index], depth - 1, alpha, beta,
+                                   searchId, deadline, maxDepth, ttSizeMB)
+            answer = submit(0, -ChessSearch.INFINITY, ChessSearch.INFINITY).result()
+            totalNodes += answer[2]
+            finished = answer[3]
+            bestIndex, score, pvNotations = 0, answer[0], answer[1]
+            if finished:
+                alpha = score
+                futures = [submit(i, alpha, alpha + 1) for i in range(1, len(moves))]
+                for i, future in enumerate(futures, 1):
+                    answer = future.result()
+                    totalNodes += answer[2]
+                    if answer[3] and answer[0] > alpha: #better than the first move, by how much is not known yet
+                        answer = submit(i, score, ChessSearch.INFINITY).result()
+                        totalNodes += answer[2]
+                    if not answer[3]:
+                        finished = False
+                        break
+                    if answer[0] > score:
+                        bestIndex, score, pvNotations = i, answer[0], answer[1]
+            if not finished: #out of time, keep the last complete iteration
+                break
+            pv = []
+            line = ChessEngine.GameState.fromSnapshot(snapshot, gs.backend)
+            for n in pvNotations:
+                move = ChessEngine.Move.fromChessNotation(n, line.board)
+                pv.append(move)
+                line.makeMove(move)
+            result = ChessSearch.SearchResult(moves[bestIndex], score, depth, pv, totalNodes,
+                                              time.perf_counter() - start)
+            if onIteration is not None:
+                onIteration(result)
+            if abs(score) > ChessSearch.MATE_BOUND and ChessSearch.MATE_SCORE - abs(score) <= depth:
+                break
+            #search the best move first next time, its score is the window for the others
+            order = [bestIndex] + [i for i in range(len(moves)) if i != bestIndex]
+            moves = [moves[i] for i in order]
+            notations = [notations[i] for i in order]
+    finally:
+        if executor is None:
+            pool.shutdown(cancel_futures=True)
+    if result is None:
+        result = ChessSearch.SearchResult(moves[0], 0, 0, [moves[0]], totalNodes, time.perf_counter() - start)
+    result.nodes = totalNodes
+    result.seconds = time.perf_counter() - start
+    result.nodesPerSecond = int(totalNodes / result.seconds) if result.seconds > 0 else 0
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="parallel perft and search for ChessEngine")
+    parser.add_argument("mode", choices=["perft", "search"])
+    parser.add_argument("--fen", help="position (default: start position)")
+    parser.add_argument("--backend", default="mailbox", choices=["mailbox", "bitboard"])
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--time", type=float, help="time budget in seconds (search only)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes (default: all cores)")
+    args = parser.parse_args(argv)
+
+    gs = ChessEngine.GameState.fromFen(args.fen, args.backend) if args.fen else ChessEngine.GameState(args.backend)
+    start = time.perf_counter()
+    if args.mode == "perft":
+        nodes, counts = parallelPerft(gs, args.depth, args.workers)
+        seconds = time.perf_counter() - start
+        print(json.dumps({"depth": args.depth, "workers": args.workers, "nodes": nodes, "seconds": round(seconds, 6),
+                          "nodesPerSecond": round(nodes / seconds) if seconds > 0 else None, "divide": counts},
+                         indent=2))
+    else:
+        result = parallelSearch(gs, args.depth, args.time, args.workers, onIteration=print)
+        print("bestmove", result.bestMove.getChessNotation() if result.bestMove else "(none)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+# Description: perft driver for the move generator. It counts the leaf nodes of the legal move tree to a given depth,
+# checks the counts against well known reference positions and reports the timings as JSON.
+#
+# usage: python ChessPerft.py                                 run the reference suite to depth 3
+#        python ChessPerft.py --depth 4 --backend bitboard    deeper, on the bitboard backend
+#        python ChessPerft.py --position kiwipete --divide    per root move counts for one position
+#        python ChessPerft.py --fen "<fen>" --depth 2         any position
+#        python ChessPerft.py --profile flat                  where the time goes, per function
+
+import argparse
+import contextlib
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import ChessEngine
+
+try:
+    import resource
+except ImportError: #not available on windows
+    resource = None
+
+#name, FEN and the expected node counts for depth 1, 2, 3, ...
+REFERENCE_POSITIONS = [
+    ("startpos", "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+     [20, 400, 8902, 197281, 4865609, 119060324]),
+    ("kiwipete", "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+     [48, 2039, 97862, 4085603, 193690690]),
+    ("position3", "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+     [14, 191, 2812, 43238, 674624, 11030083]),
+    ("position4", "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+     [6, 264, 9467, 422333, 15833292]),
+    ("position5", "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+     [44, 1486, 62379, 2103487, 89941194]),
+    ("position6", "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+     [46, 2079, 89890, 3894594, 164075551]),
+]
+
+
+#number of leaf nodes depth plies below the current position
+def perft(gs, depth):
+    if depth == 0:
+        return 1
+    moves = gs.getValidMoves()
+    if depth == 1: #bulk count, no need to make the last ply
+        return len(moves)
+    nodes = 0
+    for move in moves:
+        gs.makeMove(move)
+        nodes += perft(gs, depth - 1)
+        gs.undoMove()
+    return nodes
+
+
+#perft split by root move, keyed by the move's chess notation
+def divide(gs, depth):
+    counts = {}
+    for move in gs.getValidMoves():
+        gs.makeMove(move)
+        counts[move.getChessNotation()] = perft(gs, depth - 1)
+        gs.undoMove()
+    return counts
+
+
+def peakRssKB():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak #macOS reports bytes, linux kilobytes
+
+
+#run perft at every depth from 1 to maxDepth and return one result dict per depth
+def runPosition(name, fen, expected, maxDepth, backend="mailbox", traceMemory=False, showDivide=False):
+    results = []
+    for depth in range(1, maxDepth + 1):
+        gs = ChessEngine.GameState.fromFen(fen, backend)
+        if traceMemory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        if showDivide:
+            counts = divide(gs, depth)
+            nodes = sum(counts.values())
+        else:
+            nodes = perft(gs, depth)
+        seconds = time.perf_counter() - start
+        result = {
+            "position": name,
+            "fen": fen,
+            "backend": backend,
+            "depth": depth,
+            "nodes": nodes,
+            "expected": expected[depth - 1] if depth <= len(expected) else None,
+            "seconds": round(seconds, 6),
+            "nodesPerSecond": round(nodes / seconds) if seconds > 0 else None,
+            "peakRssKB": peakRssKB(),
+        }
+        result["ok"] = result["expected"] is None or nodes == result["expected"]
+        if traceMemory:
+            result["peakTracedKB"] = tracemalloc.get_traced_memory()[1] // 1024
+            tracemalloc.stop()
+        if showDivide:
+            result["divide"] = counts
+        results.append(result)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="perft and divide benchmark for ChessEngine")
+    parser.add_argument("--depth", type=int, default=3, help="maximum depth (default 3)")
+    parser.add_argument("--backend", default="mailbox", choices=["mailbox", "bitboard"])
+    parser.add_argument("--position", action="append", help="reference position name, can be repeated")
+    parser.add_argument("--fen", help="run a custom position instead of the reference suite")
+    parser.add_argument("--divide", action="store_true", help="include per root move counts")
+    parser.add_argument("--trace-memory", action="store_true", help="measure peak python heap with tracemalloc (slower)")
+    parser.add_argument("--output", help="write the JSON report to a file instead of stdout")
+    parser.add_argument("--profile", choices=["flat", "cprofile"],
+                        help="per function call counts and timings on stderr (slower)")
+    args = parser.parse_args(argv)
+
+    if args.fen:
+        positions = [("custom", args.fen, [])]
+    else:
+        positions = [p for p in REFERENCE_POSITIONS if not args.position or p[0] in args.position]
+        if not positions:
+            parser.error("unknown position, choose from: " + ", ".join(p[0] for p in REFERENCE_POSITIONS))
+
+    results = []
+    if args.profile:
+        measured = ChessEngine.instrumented("cprofile" if args.profile == "cprofile" else None)
+    else:
+        measured = contextlib.nullcontext()
+    with measured:
+        for name, fen, expected in positions:
+            results.extend(runPosition(name, fen, expected, args.depth, args.backend, args.trace_memory, args.divide))
+    report = {
+        "python": platform.python_implementation() + " " + platform.python_version(),
+        "backend": args.backend,
+        "totalNodes": sum(r["nodes"] for r in results),
+        "totalSeconds": round(sum(r["seconds"] for r in results), 6),
+        "ok": all(r["ok"] for r in results),
+        "results": results,
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0 if report["ok"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,308 @@
+# Description: move search on top of GameState. Negamax alpha-beta with iterative deepening, aspiration windows,
+# quiescence search on captures, transposition table, killer and history move ordering, and a time or node budget.
+#
+# usage: python ChessSearch.py --fen "<fen>" --time 5      search a position for 5 seconds
+#        python ChessSearch.py --depth 4                   search the start position to depth 4
+
+import argparse
+import threading
+import time
+
+import ChessEngine
+
+MATE_SCORE = 100000
+MATE_BOUND = MATE_SCORE - 1000 #scores beyond this are mates, the distance is counted in plies
+INFINITY = MATE_SCORE + 1
+ASPIRATION_WINDOW = 50
+
+
+#static evaluation in centipawns from the point of view of the side to move, kept up to date by makeMove/undoMove
+def evaluate(gs):
+    return gs.evaluate()
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+class SearchResult():
+    def __init__(self, bestMove, score, depth, pv, nodes, seconds):
+        self.bestMove = bestMove
+        self.score = score
+        self.depth = depth
+        self.pv = pv #principal variation, list of Move
+        self.nodes = nodes
+        self.seconds = seconds
+        self.nodesPerSecond = int(nodes / seconds) if seconds > 0 else 0
+
+    def isMate(self):
+        return abs(self.score) > MATE_BOUND
+
+    def __str__(self):
+        return "depth %d score %d nodes %d nps %d pv %s" % (self.depth, self.score, self.nodes, self.nodesPerSecond,
+                                                          " ".join(m.getChessNotation() for m in self.pv))
+
+
+class Searcher():
+    #book is an optional ChessBook.OpeningBook, a position found in it is answered with a book move and no search.
+    #tablebase is an optional ChessTablebase.Tablebase: a root position in it is answered straight from the tables,
+    #and captures that lead into it are scored exactly instead of searched further
+    def __init__(self, transpositionTable=None, ttSizeMB=16, book=None, tablebase=None):
+        self.tt = transpositionTable if transpositionTable is not None else ChessEngine.TranspositionTable(ttSizeMB)
+        self.book = book
+        self.tablebase = tablebase
+        self.killers = []
+        self.history = {}
+        self.nodes = 0
+        self.deadline = None
+        self.nodeLimit = None
+        self.stopEvent = threading.Event()
+
+    #iterative deepening search. stops at maxDepth, after timeLimit seconds, after nodeLimit nodes or when stopEvent
+    #(a threading.Event, a fresh one if not given) is set, whichever comes first, and returns the result of the last
+    #completed iteration. onIteration(result) is called after every depth
+    def search(self, gs, maxDepth=64, timeLimit=None, nodeLimit=None, onIteration=None, stopEvent=None):
+        start = time.perf_counter()
+        if self.book is not None:
+            bookMove = self.book.chooseMove(gs)
+            if bookMove is not None:
+                return SearchResult(bookMove, 0, 0, [bookMove], 0, time.perf_counter() - start)
+        if self.tablebase is not None:
+            found = self.tablebase.bestMove(gs)
+            if found is not None:
+                move, wdl, plies = found
+                return SearchResult(move, tablebaseScore(wdl, plies, 0), 0, [move], 0, time.perf_counter() - start)
+        self.prepare(start + timeLimit if timeLimit is not None else None, nodeLimit, maxDepth, stopEvent)
+        ownsTable = gs.transpositionTable is None
+        if ownsTable: #share the table so legal move lists are cached across iterations too
+            gs.transpositionTable = self.tt
+
+        result = None
+        rootMoves = gs.getValidMoves()
+        try:
+            if not rootMoves:
+                score = -MATE_SCORE if gs.inCheck else 0
+                return SearchResult(None, score, 0, [], 0, time.perf_counter() - start)
+            score = 0
+            for depth in range(1, maxDepth + 1):
+                if self.stopEvent.is_set(): #checkBudget runs every 1024 nodes, a shallow depth may never get there
+                    break
+                try:
+                    if depth >= 4: #aspiration window around the last score, widened on failure
+                        alpha, beta = score - ASPIRATION_WINDOW, score + ASPIRATION_WINDOW
+                        score, pv = self.negamax(gs, depth, alpha, beta, 0)
+                        if score <= alpha or score >= beta:
+                            score, pv = self.negamax(gs, depth, -INFINITY, INFINITY, 0)
+                    else:
+                        score, pv = self.negamax(gs, depth, -INFINITY, INFINITY, 0)
+                except SearchTimeout:
+                    break
+                result = SearchResult(pv[0] if pv else rootMoves[0], score, depth, pv, self.nodes,
+                                      time.perf_counter() - start)
+                if onIteration is not None:
+                    onIteration(result)
+                if abs(score) > MATE_BOUND and MATE_SCORE - abs(score) <= depth: #found the shortest mate
+                    break
+            if result is None: #not even depth 1 finished, fall back on the first legal move
+                result = SearchResult(rootMoves[0], 0, 0, [rootMoves[0]], self.nodes, time.perf_counter() - start)
+            result.nodes = self.nodes
+            result.seconds = time.perf_counter() - start
+            result.nodesPerSecond = int(result.nodes / result.seconds) if result.seconds > 0 else 0
+            return result
+        finally:
+            if ownsTable:
+                gs.transpositionTable = None
+
+    #reset the per-search state. deadline is a time.perf_counter() value, callers driving negamax directly (like the
+    #parallel root split) call this themselves
+    def prepare(self, deadline=None, nodeLimit=None, maxDepth=64, stopEvent=None):
+        self.deadline = deadline
+        self.nodeLimit = nodeLimit
+        self.stopEvent = stopEvent if stopEvent is not None else threading.Event()
+        self.nodes = 0
+        self.killers = [[None, None] for _ in range(maxDepth + 64)]
+        self.history = {}
+        self.tt.newSearch()
+
+    #ask the running search to finish, from another thread. it returns the last completed iteration as if the time
+    #had run out. only that search is stopped, the next one gets a new stop event. a caller that can't be sure the
+    #search has started yet passes its own stopEvent to search() and sets that instead
+    def stop(self):
+        self.stopEvent.set()
+
+    def checkBudget(self):
+        if self.stopEvent.is_set():
+            raise SearchTimeout()
+        if self.nodeLimit is not None and self.nodes >= self.nodeLimit:
+            raise SearchTimeout()
+        if self.deadline is not None and time.perf_counter() >= self.deadline:
+            raise SearchTimeout()
+
+    #returns (score, principal variation) from the side to move's point of view
+    def negamax(self, gs, depth, alpha, beta, ply):
+        self.nodes += 1
+        if self.nodes & 1023 == 0:
+            self.checkBudget()
+        if ply > 0 and gs.isRepetition(2):
+            return 0, []
+        if self.tablebase is not None and ply > 0 and gs.moveLog[-1].pieceCaptured != "--":
+            #only a capture can bring the piece count down into the tables
+            found = self.tablebase.probe(gs)
+            if found is not None:
+                return tablebaseScore(found[0], found[1], ply), []
+
+        key = gs.zobristKey
+        entry = self.tt.probe(key)
+        ttMove = None
+        if entry is not None and entry.depth >= 0:
+            ttMove = entry.bestMove
+            if ply > 0 and entry.depth >= depth:
+                score = scoreFromTable(entry.score, ply)
+                if entry.flag == ChessEngine.TranspositionTable.EXACT or \
+                        (entry.flag == ChessEngine.TranspositionTable.LOWER and score >= beta) or \
+                        (entry.flag == ChessEngine.TranspositionTable.UPPER and score <= alpha):
+                    return score, [ttMove] if ttMove is not None else []
+
+        #moves come one stage at a time, most nodes cut off before the quiet moves are even generated
+        moves = gs.getStagedMoves(ttMove, self.killers[ply], self.historyScore, capturesOnly=depth <= 0)
+        inCheck = gs.inCheck #gs.inCheck is overwritten by the nodes below
+        if inCheck:
+            depth += 1 #check extension, so forced lines are not cut off at the horizon
+        if depth <= 0:
+            return self.quiescence(gs, alpha, beta, ply, moves), []
+
+        originalAlpha = alpha
+        bestScore = -INFINITY
+        bestMove = None
+        bestPv = []
+        for move in moves:
+            gs.makeMove(move)
+            try:
+                score, childPv = self.negamax(gs, depth - 1, -beta, -alpha, ply + 1)
+            finally:
+                gs.undoMove()
+            score = -score
+            if score > bestScore:
+                bestScore = score
+                bestMove = move
+                bestPv = [move] + childPv
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        if move.pieceCaptured == "--" and move.promotionPiece is None: #quiet move that caused a cut-off
+                            killers = self.killers[ply]
+                            if killers[0] != move:
+                                killers[1] = killers[0]
+                                killers[0] = move
+                            historyKey = (move.pieceMoved, move.moveID)
+                            self.history[historyKey] = self.history.get(historyKey, 0) + depth * depth
+                        break
+        if bestMove is None: #no legal move
+            return (-MATE_SCORE + ply if inCheck else 0), []
+
+        if bestScore <= originalAlpha:
+            flag = ChessEngine.TranspositionTable.UPPER
+        elif bestScore >= beta:
+            flag = ChessEngine.TranspositionTable.LOWER
+        else:
+            flag = ChessEngine.TranspositionTable.EXACT
+        self.tt.store(key, depth, scoreToTable(bestScore, ply), flag, bestMove)
+        return bestScore, bestPv
+
+    #search captures only until the position is quiet, so the static evaluation is never taken in the middle of an
+    #exchange. in check every evasion is searched instead. moves can be passed in when the caller already asked for
+    #the staged moves of this position
+    def quiescence(self, gs, alpha, beta, ply, moves=None):
+        if moves is None:
+            self.nodes += 1
+            if self.nodes & 1023 == 0:
+                self.checkBudget()
+            moves = gs.getStagedMoves(capturesOnly=True)
+        inCheck = gs.inCheck
+        if not inCheck: #stand pat, the side to move can usually do at least as well as the static evaluation
+            standPat = evaluate(gs)
+            if standPat >= beta:
+                return standPat
+            if standPat > alpha:
+                alpha = standPat
+        searched = False
+        for move in moves:
+            searched = True
+            gs.makeMove(move)
+            try:
+                score = -self.quiescence(gs, -beta, -alpha, ply + 1)
+            finally:
+                gs.undoMove()
+            if score >= beta:
+                return score
+            if score > alpha:
+                alpha = score
+        if inCheck and not searched:
+            return -MATE_SCORE + ply
+        return alpha
+
+    #quiet moves are tried in order of how often they caused cut-offs before
+    def historyScore(self, move):
+        return self.history.get((move.pieceMoved, move.moveID), 0)
+
+
+#search score of a tablebase result found ply plies from the root
+def tablebaseScore(wdl, plies, ply):
+    if wdl > 0:
+        return MATE_SCORE - ply - plies
+    if wdl < 0:
+        return -MATE_SCORE + ply + plies
+    return 0
+
+
+#mate scores are stored relative to the node so they stay correct when reached from a different ply
+def scoreToTable(score, ply):
+    if score > MATE_BOUND:
+        return score + ply
+    if score < -MATE_BOUND:
+        return score - ply
+    return score
+
+
+def scoreFromTable(score, ply):
+    if score > MATE_BOUND:
+        return score - ply
+    if score < -MATE_BOUND:
+        return score + ply
+    return score
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="search a position with ChessEngine")
+    parser.add_argument("--fen", help="position to search (default: start position)")
+    parser.add_argument("--backend", default="mailbox", choices=["mailbox", "bitboard"])
+    parser.add_argument("--depth", type=int, default=64, help="maximum depth")
+    parser.add_argument("--time", type=float, help="time budget in seconds")
+    parser.add_argument("--nodes", type=int, help="node budget")
+    parser.add_argument("--hash", type=int, default=16, help="transposition table size in MB")
+    parser.add_argument("--book", help="Polyglot opening book to play from before searching")
+    parser.add_argument("--tablebase", help="directory of ChessTablebase.py endgame tables")
+    args = parser.parse_args(argv)
+    if args.time is None and args.nodes is None and args.depth == 64:
+        args.time = 5
+
+    gs = ChessEngine.GameState.fromFen(args.fen, args.backend) if args.fen else ChessEngine.GameState(args.backend)
+    book = None
+    if args.book:
+        import ChessBook
+        book = ChessBook.OpeningBook(args.book)
+    tablebase = None
+    if args.tablebase:
+        import ChessTablebase
+        tablebase = ChessTablebase.Tablebase(args.tablebase)
+    searcher = Searcher(ttSizeMB=args.hash, book=book, tablebase=tablebase)
+    result = searcher.search(gs, args.depth, args.time, args.nodes, onIteration=print)
+    if book is not None:
+        book.close()
+    if tablebase is not None:
+        tablebase.close()
+    print("bestmove", result.bestMove.getChessNotation() if result.bestMove else "(none)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,473 @@
+# Description: endgame tablebases for small material sets (KQK, KRK, KPK, KRKN, ...). Every position of a material
+# set gets one byte: win, draw or loss for the side to move and the distance to mate in plies. The generator works
+# backwards from the mates (retrograde analysis): legal moves come from GameState, positions that were one move
+# before a solved one are found by taking the move back, and captures and promotions look the result up in the
+# smaller tables, which are generated first. Positions are stored once per symmetry: without pawns the white king is
+# moved into the a1-d1-d4 triangle, with pawns into the a-d files. Probes read the byte straight out of the
+# memory-mapped file.
+# Castling rights are never part of a table and en passant captures are not generated, a double pawn step that would
+# allow one is scored as if it didn't. 3 piece tables take seconds to generate, 4 piece tables tens of minutes.
+#
+# usage: python ChessTablebase.py generate KQK KRK KPK --dir tables
+#        python ChessTablebase.py probe --fen "<fen>" --dir tables
+
+import argparse
+import mmap
+import os
+import struct
+import sys
+import time
+
+import ChessEngine
+
+MAGIC = b"CTB1"
+HEADER = struct.Struct(">4s8sI") #magic, material, positions per side to move
+DRAW = 0
+LOSS = 128 #a loss is stored as LOSS + plies to mate, a win as the plies to mate
+MAX_PLIES = 125
+UNKNOWN = 254 #only while generating, positions still unknown at the end are draws
+INVALID = 255 #impossible positions and the symmetric copies of stored ones
+MAX_PIECES = 4
+PIECE_ORDER = "QRBNP"
+PIECE_VALUES = {'Q': 9, 'R': 5, 'B': 3, 'N': 3, 'P': 1}
+TRIVIAL_DRAWS = ("KK", "KBK", "KNK") #no mate is possible at all, so there is no table
+WIN_SCORE = 1000 #scores of the capture and promotion exits while generating: win in n plies is WIN_SCORE - n
+
+
+def mirrorSquare(sq, flipRows, flipCols, swap):
+    r, c = divmod(sq, 8)
+    if flipRows:
+        r = 7 - r
+    if flipCols:
+        c = 7 - c
+    if swap: #reflection in the a1-h8 diagonal
+        r, c = 7 - c, 7 - r
+    return r*8 + c
+
+
+#TRANSFORMS[pawns][white king square] lists the square maps that bring the white king into its part of the board.
+#a king on the a1-h8 diagonal stays there under the reflection in it, so it gets two maps and the smaller result is
+#stored
+def buildTransforms(pawns):
+    transforms = []
+    for kingSq in range(64):
+        r, c = divmod(kingSq, 8)
+        if pawns: #pawns only allow the mirror between the king side and the queen side
+            options = [(False, c > 3, False)]
+        else:
+            flipRows, flipCols = r < 4, c > 3
+            r, c = divmod(mirrorSquare(kingSq, flipRows, flipCols, False), 8)
+            options = [(flipRows, flipCols, 7 - r > c)]
+            if 7 - r == c:
+                options.append((flipRows, flipCols, True))
+        transforms.append([[mirrorSquare(sq, *option) for sq in range(64)] for option in options])
+    return transforms
+
+
+TRANSFORMS = {False: buildTransforms(False), True: buildTransforms(True)}
+KING_SQUARES = {pawns: [sq for sq in range(64) if TRANSFORMS[pawns][sq][0][sq] == sq] for pawns in (False, True)}
+
+
+def sideName(kinds):
+    return "K" + "".join(sorted(kinds, key=PIECE_ORDER.index))
+
+
+def sideStrength(side):
+    return len(side), sum(PIECE_VALUES[kind] for kind in side[1:]), [-PIECE_ORDER.index(kind) for kind in side[1:]]
+
+
+#canonical material name of a set of pieces ("wK", "bR", ...) and whether the colours have to be swapped to find
+#the position in it. the stronger side is always white: KRKN, never KNKR
+def materialName(pieces):
+    white, black = [], []
+    for piece in pieces:
+        if piece[1] != 'K':
+            (white if piece[0] == 'w' else black).append(piece[1].upper())
+    white, black = sideName(white), sideName(black)
+    if sideStrength(black) > sideStrength(white):
+        return black + white, True
+    return white + black, False
+
+
+#the pieces of a material name in table order: white king, white pieces, black king, black pieces
+def materialPieces(name):
+    split = name.index('K', 1)
+    return ["w" + ('p' if kind == 'P' else kind) for kind in name[:split]] + \
+           ["b" + ('p' if kind == 'P' else kind) for kind in name[split:]]
+
+
+#the same position with the colours swapped and the board turned upside down
+def flipPieces(pieces):
+    return [(("b" if piece[0] == 'w' else "w") + piece[1], (7 - sq // 8)*8 + sq % 8) for piece, sq in pieces]
+
+
+#(wdl, plies to mate) of a value byte from the side to move's point of view, wdl is 1, 0 or -1
+def decodeValue(value):
+    if value == DRAW:
+        return 0, 0
+    if value < LOSS:
+        return 1, value
+    return -1, value - LOSS
+
+
+class Table():
+    #one material set. data holds one byte per index from offset on, all white to move positions first
+    def __init__(self, name, data=None, offset=0):
+        self.name = name
+        self.data = data
+        self.offset = offset
+        self.slots = materialPieces(name)
+        self.pawns = any(piece[1] == 'p' for piece in self.slots)
+        self.kingSquares = KING_SQUARES[self.pawns]
+        self.kingIndex = {sq: i for i, sq in enumerate(self.kingSquares)}
+        self.size = len(self.kingSquares) * 64 ** (len(self.slots) - 1)
+        #runs of identical pieces, their squares are kept sorted so swapping two rooks is the same position
+        self.groups = []
+        start = 0
+        for i in range(1, len(self.slots) + 1):
+            if i == len(self.slots) or self.slots[i] != self.slots[start]:
+                if i - start > 1:
+                    self.groups.append((start, i))
+                start = i
+
+    #the stored representative of a position given as squares in table order
+    def canonical(self, squares):
+        best = None
+        for transform in TRANSFORMS[self.pawns][squares[0]]:
+            mapped = [transform[sq] for sq in squares]
+            for start, end in self.groups:
+                mapped[start:end] = sorted(mapped[start:end])
+            if best is None or mapped < best:
+                best = mapped
+        return best
+
+    def index(self, squares, whiteToMove):
+        squares = self.canonical(squares)
+        index = self.kingIndex[squares[0]]
+        for sq in squares[1:]:
+            index = index*64 + sq
+        return index if whiteToMove else index + self.size
+
+    #(squares in table order, white to move) of an index
+    def position(self, index):
+        whiteToMove = index < self.size
+        index %= self.size
+        squares = []
+        for _ in range(len(self.slots) - 1):
+            index, sq = divmod(index, 64)
+            squares.append(sq)
+        squares.append(self.kingSquares[index])
+        squares.reverse()
+        return squares, whiteToMove
+
+    #squares in table order for (piece, square) pairs of this material
+    def squaresFor(self, pieces):
+        free = {}
+        for piece, sq in pieces:
+            free.setdefault(piece, []).append(sq)
+        return [free[piece].pop() for piece in self.slots]
+
+    def value(self, index):
+        return self.data[self.offset + index]
+
+    #indexes of the valid positions one move before the position at index: every piece of the side that just moved
+    #is taken back along its moves. captures and promotions lead out of the table, so they are never taken back
+    def parents(self, index, values):
+        squares, whiteToMove = self.position(index)
+        mover = 'b' if whiteToMove else 'w'
+        occupied = set(squares)
+        found = set()
+        for i, piece in enumerate(self.slots):
+            if piece[0] != mover:
+                continue
+            sq = squares[i]
+            kind = piece[1]
+            if kind == 'p':
+                step = 8 if mover == 'w' else -8 #white pawns come from the row below, black from the row above
+                origins = []
+                origin = sq + step
+                if 8 <= origin < 56 and origin not in occupied:
+                    origins.append(origin)
+                    if sq // 8 == (4 if mover == 'w' else 3) and origin + step not in occupied:
+                        origins.append(origin + step)
+            elif kind == 'N' or kind == 'K':
+                origins = [target for target in ChessEngine.ATTACKS_BY_STEP[kind][sq] if target not in occupied]
+            else:
+                origins = []
+                for _, ray in ChessEngine.SLIDER_RAYS[kind][sq]:
+                    for r, c in ray:
+                        if r*8 + c in occupied:
+                            break
+                        origins.append(r*8 + c)
+            for origin in origins:
+                squares[i] = origin
+                parent = self.index(squares, mover == 'w')
+                if values[parent] != INVALID:
+                    found.add(parent)
+            squares[i] = sq
+        return found
+
+
+class Tablebase():
+    #tables are looked up in directory by material name (KRKN.ctb) and mapped on first use
+    def __init__(self, directory):
+        self.directory = directory
+        self.tables = {}
+        self.files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for f, data in self.files:
+            data.close()
+            f.close()
+        self.files = []
+        self.tables = {}
+
+    def path(self, name):
+        return os.path.join(self.directory, name + ".ctb")
+
+    #the Table of a canonical material name, or None if it has not been generated
+    def table(self, name):
+        if name not in self.tables:
+            self.tables[name] = self.openTable(name) if os.path.exists(self.path(name)) else None
+        return self.tables[name]
+
+    def openTable(self, name):
+        f = open(self.path(name), "rb")
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, material, size = HEADER.unpack_from(data, 0)
+        table = Table(name, data, HEADER.size)
+        if magic != MAGIC or material.rstrip(b"\0") != name.encode() or size != table.size or \
+                len(data) != HEADER.size + 2*size:
+            data.close()
+            f.close()
+            raise ValueError("not a tablebase file for " + name + ": " + self.path(name))
+        self.files.append((f, data))
+        return table
+
+    #value byte of a position given as (piece, square) pairs, None if its table has not been generated
+    def lookup(self, pieces, whiteToMove):
+        name, flipped = materialName(piece for piece, _ in pieces)
+        if name in TRIVIAL_DRAWS:
+            return DRAW
+        if flipped:
+            pieces = flipPieces(pieces)
+            whiteToMove = not whiteToMove
+        table = self.table(name)
+        if table is None:
+            return None
+        return table.value(table.index(table.squaresFor(pieces), whiteToMove))
+
+    #(wdl, plies to mate) for the side to move, wdl is 1 for a win, 0 for a draw and -1 for a loss. None when the
+    #position is not in a table: too many pieces, castling rights or an en passant square, or no table generated
+    def probe(self, gs):
+        if gs.castlingRights or gs.enpassantPossible:
+            return None
+        pieces = []
+        for r in range(8):
+            for c in range(8):
+                if gs.board[r][c] != "--":
+                    pieces.append((gs.board[r][c], r*8 + c))
+        if len(pieces) > MAX_PIECES:
+            return None
+        value = self.lookup(pieces, gs.whiteToMove)
+        if value is None or value == INVALID:
+            return None
+        return decodeValue(value)
+
+    #(move, wdl, plies to mate) of the best move: the fastest win, a move that holds the draw or the slowest loss.
+    #None when the position or one of its children is not covered
+    def bestMove(self, gs):
+        result = self.probe(gs)
+        if result is None:
+            return None
+        best = None
+        bestScore = None
+        for move in gs.getValidMoves():
+            gs.makeMove(move)
+            child = self.probe(gs)
+            gs.undoMove()
+            if child is None:
+                return None
+            wdl, plies = child
+            score = -wdl * WIN_SCORE + wdl * (plies + 1) #the faster win and the slower loss score higher
+            if bestScore is None or score > bestScore:
+                best, bestScore = move, score
+        if best is None:
+            return None
+        return best, result[0], result[1]
+
+
+#material sets reachable from a table by one capture or promotion
+def subMaterials(name):
+    pieces = materialPieces(name)
+    found = []
+    for i, piece in enumerate(pieces):
+        if piece[1] == 'K':
+            continue
+        options = [pieces[:i] + pieces[i + 1:]]
+        if piece[1] == 'p':
+            options += [pieces[:i] + [piece[0] + kind] + pieces[i + 1:] for kind in ChessEngine.PROMOTION_PIECES]
+            options += [option[:j] + option[j + 1:] for option in options[1:] for j in range(len(option))
+                        if option[j][0] != piece[0] and option[j][1] != 'K']
+        for option in options:
+            sub, _ = materialName(option)
+            if sub not in found and sub != name:
+                found.append(sub)
+    return found
+
+
+#generate the table of a material set, and any smaller table it needs, into tablebase.directory. progress(name,
+#positions, seconds) is called after every table
+def generate(name, tablebase, progress=None):
+    name, _ = materialName(materialPieces(name))
+    if name in TRIVIAL_DRAWS or tablebase.table(name) is not None:
+        return
+    if len(materialPieces(name)) > MAX_PIECES:
+        raise ValueError("tables have at most %d pieces: %s" % (MAX_PIECES, name))
+    for sub in subMaterials(name):
+        generate(sub, tablebase, progress)
+    start = time.perf_counter()
+    table = Table(name)
+    values = bytearray([INVALID]) * (2*table.size)
+    remaining = bytearray(2*table.size) #moves to positions inside the table not yet known to lose for the mover
+    exits = bytearray(2*table.size) #longest loss after a capture or promotion, or INVALID if one wins or draws
+    frontier = [] #positions solved at the current level, mates first
+    pending = {} #level: [(index, value)] for positions solved by a capture or promotion, or only later
+    valid = 0
+
+    #forward pass: every position is set up on a GameState for its legal moves
+    for index in range(2*table.size):
+        squares, whiteToMove = table.position(index)
+        if len(set(squares)) < len(squares) or table.canonical(squares) != squares:
+            continue
+        if any(piece[1] == 'p' and sq // 8 in (0, 7) for piece, sq in zip(table.slots, squares)):
+            continue
+        board = [["--"]*8 for _ in range(8)]
+        for piece, sq in zip(table.slots, squares):
+            board[sq // 8][sq % 8] = piece
+        gs = ChessEngine.GameState(board=board, whiteToMove=whiteToMove, castlingRights=0)
+        enemyKing = gs.blackKingLocation if whiteToMove else gs.whiteKingLocation
+        if gs.squareAttackedBy(enemyKing[0], enemyKing[1], 'w' if whiteToMove else 'b'):
+            continue #the side that just moved can't be in check
+        valid += 1
+        moves = gs.getValidMoves()
+        if not moves:
+            if gs.inCheck:
+                values[index] = LOSS
+                frontier.append(index)
+            else:
+                values[index] = DRAW
+            continue
+        values[index] = UNKNOWN
+        slotAt = {sq: i for i, sq in enumerate(squares)}
+        children = set()
+        bestExit = None
+        for move in moves:
+            startSq, endSq = move.moveID & 63, move.moveID >> 6 & 63
+            if move.pieceCaptured == "--" and move.promotionPiece is None:
+                squares[slotAt[startSq]] = endSq
+                children.add(table.index(squares, not whiteToMove))
+                squares[slotAt[startSq]] = startSq
+                continue
+            pieces = []
+            for piece, sq in zip(table.slots, squares):
+                if sq == endSq: #captured
+                    continue
+                if sq == startSq:
+                    sq = endSq
+                    if move.promotionPiece is not None:
+                        piece = piece[0] + move.promotionPiece
+                pieces.append((piece, sq))
+            wdl, plies = decodeValue(tablebase.lookup(pieces, not whiteToMove))
+            score = -wdl * (WIN_SCORE - plies - 1)
+            if bestExit is None or score > bestExit:
+                bestExit = score
+        remaining[index] = len(children)
+        if bestExit is not None and bestExit >= 0:
+            exits[index] = INVALID
+            if bestExit > 0:
+                pending.setdefault(WIN_SCORE - bestExit, []).append((index, WIN_SCORE - bestExit))
+            elif not children:
+                values[index] = DRAW
+        elif bestExit is not None:
+            exits[index] = WIN_SCORE + bestExit
+            if not children:
+                pending.setdefault(exits[index], []).append((index, LOSS + exits[index]))
+
+    #backward pass, one ply per level: a parent of a lost position wins, a parent all of whose moves lead to won
+    #positions loses once the slowest of them is reached
+    level = 0
+    while frontier or pending:
+        nextFrontier = []
+        for index in frontier:
+            lost = values[index] >= LOSS
+            for parent in table.parents(index, values):
+                if values[parent] != UNKNOWN:
+                    continue
+                if lost:
+                    values[parent] = level + 1
+                    nextFrontier.append(parent)
+                else:
+                    remaining[parent] -= 1
+                    if remaining[parent] == 0 and exits[parent] != INVALID:
+                        plies = max(level + 1, exits[parent])
+                        pending.setdefault(plies, []).append((parent, LOSS + plies))
+        level += 1
+        if level > MAX_PLIES and (nextFrontier or pending):
+            raise ValueError("mate in more than %d plies does not fit in %s" % (MAX_PLIES, name))
+        for index, value in pending.pop(level, ()):
+            if values[index] == UNKNOWN:
+                values[index] = value
+                nextFrontier.append(index)
+        frontier = nextFrontier
+
+    values = values.replace(bytes([UNKNOWN]), bytes([DRAW]))
+    os.makedirs(tablebase.directory, exist_ok=True)
+    path = tablebase.path(name)
+    with open(path + ".tmp", "wb") as f:
+        f.write(HEADER.pack(MAGIC, name.encode(), table.size))
+        f.write(values)
+    os.replace(path + ".tmp", path)
+    tablebase.tables.pop(name, None)
+    if progress is not None:
+        progress(name, valid, time.perf_counter() - start)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="generate and probe endgame tablebases")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("generate", help="generate tables and the smaller ones they need")
+    build.add_argument("material", nargs="+", help="material sets such as KQK KRK KPK KRKN")
+    build.add_argument("--dir", default="tables", help="table directory")
+    probe = commands.add_parser("probe", help="look a position up")
+    probe.add_argument("--fen", required=True)
+    probe.add_argument("--dir", default="tables", help="table directory")
+    args = parser.parse_args(argv)
+
+    with Tablebase(args.dir) as tablebase:
+        if args.command == "generate":
+            def report(name, positions, seconds):
+                print("%s: %d positions in %.1fs" % (name, positions, seconds))
+            for name in args.material:
+                generate(name.upper(), tablebase, report)
+        else:
+            gs = ChessEngine.GameState.fromFen(args.fen)
+            result = tablebase.probe(gs)
+            if result is None:
+                print("not in the tablebase")
+                return 1
+            wdl, plies = result
+            found = tablebase.bestMove(gs)
+            print(" ".join([{1: "win", 0: "draw", -1: "loss"}[wdl]] + (["mate in %d plies" % plies] if wdl else []) +
+                           (["bestmove", found[0].getChessNotation()] if found else [])))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())